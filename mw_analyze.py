@@ -29,11 +29,33 @@
 #
 ## Split transactions that don't add up or have split amounts that do
 ## not have buckets assigned (in bucketed accounts).
+#
+## Transactions that look like duplicates of each other (the same
+## amount and payee in the same account within a few days).
+#
+## Buckets whose balance went negative, and the transaction or money
+## flow that took them there.
 
 import argparse
+import array
+import ast
+import BaseHTTPServer
+import bisect
+import copy
+import csv
 import datetime
+import json
+import math
 import os
+import re
+import SocketServer
 import sqlite3
+import StringIO
+import struct
+import sys
+import threading
+import time
+import urlparse
 
 # Describes an account
 class Account:
@@ -116,8 +138,16 @@ class MoneyFlow:
             (self.key, self.date.isoformat(), self.amount, self.memo,
              self.bucket, self.transfer_sibling )
 
+# Dates already converted by date_from_ymd().  A document has far
+# fewer distinct dates than rows, so this saves most of the work of
+# converting them.
+ymd_dates = {}
+
 # Converts a date in YYYYMMDD format to a datetime.date object
 def date_from_ymd(ymd):
+    if ymd in ymd_dates:
+        return ymd_dates[ymd]
+
     y = ymd / 10000
     m = (ymd / 100) % 100
     d = ymd % 100
@@ -128,6 +158,7 @@ def date_from_ymd(ymd):
         print 'Error converting ymd %d to a date' % (ymd)
         raise
 
+    ymd_dates[ymd] = date
     return date
 
 #
@@ -190,6 +221,42 @@ def flow_amount_sum(flows):
         flows = flows.values()
     return round(sum(map(lambda flow: flow.amount, flows)), 2)
 
+# Converts an amount in dollars (as stored in the data file) to an
+# integer number of cents, so that long running sums don't accumulate
+# floating point error.
+def amount_to_cents(amount):
+    return int(round(amount * 100))
+
+# Converts an integer number of cents back to a dollar amount
+def cents_to_amount(cents):
+    return round(cents / 100.0, 2)
+
+# Returns a payee name with case, punctuation and anything that looks
+# like a reference or store number removed, so that payees that were
+# imported or typed slightly differently compare equal.
+def normalize_payee(payee):
+    if not payee:
+        return ''
+    words = ''.join([c if c.isalnum() else ' ' for c in payee.lower()]).split()
+    return ' '.join([word for word in words if not any([c.isdigit() for c in word])])
+
+# Returns the month that contains the date as a YYYYMM integer
+def month_from_date(date):
+    return date.year * 100 + date.month
+
+# Returns the last day of a YYYYMM month as a datetime.date object
+def month_end_date(month):
+    y = month / 100
+    m = month % 100
+    if m == 12:
+        return datetime.date(y, 12, 31)
+    return datetime.date(y, m + 1, 1) - datetime.timedelta(days=1)
+
+# Returns the YYYYMM month that follows the specified month
+def next_month(month):
+    if month % 100 == 12:
+        return month + 100 - 11
+    return month + 1
 
 
 # A simple date range class
@@ -205,25 +272,259 @@ class DateRange:
         return '%s to %s' % (self.datestart.isoformat(), self.dateend.isoformat())
 
 
+# The monthly activity of a single account or bucket.  'cells' is a
+# dictionary mapping a YYYYMM month to a list of [activity, inflow,
+# outflow] for that month, all in cents.  The months are kept sorted
+# along with running totals so that the balance at the end of any
+# month, or the activity over any range of months, can be found with
+# a binary search instead of a rescan of the transactions.
+class MonthlySeries:
+    def __init__(self, opening_balance, cells):
+        self.opening_balance = opening_balance
+        self.months = sorted(cells.keys())
+
+        # Running totals, with a leading 0 so that the total through
+        # the i'th month is at index i+1.
+        self.activity = [0]
+        self.inflow = [0]
+        self.outflow = [0]
+        for month in self.months:
+            cell = cells[month]
+            self.activity.append(self.activity[-1] + cell[0])
+            self.inflow.append(self.inflow[-1] + cell[1])
+            self.outflow.append(self.outflow[-1] + cell[2])
+
+    # Returns the cells this series was built from (used to save it).
+    def cells(self):
+        return [(self.months[i],
+                 self.activity[i+1] - self.activity[i],
+                 self.inflow[i+1] - self.inflow[i],
+                 self.outflow[i+1] - self.outflow[i]) for i in range(len(self.months))]
+
+    # Returns the balance in cents at the end of the specified month.
+    def balance(self, month):
+        return self.opening_balance + self.activity[bisect.bisect_right(self.months, month)]
+
+    # Returns a tuple of (activity, inflow, outflow) in cents for the
+    # first through last months (inclusive).
+    def totals(self, first_month, last_month):
+        lo = bisect.bisect_left(self.months, first_month)
+        hi = bisect.bisect_right(self.months, last_month)
+        if hi < lo:
+            hi = lo
+        return (self.activity[hi] - self.activity[lo],
+                self.inflow[hi] - self.inflow[lo],
+                self.outflow[hi] - self.outflow[lo])
+
+# A precomputed (month x account) and (month x bucket) rollup of a
+# data file.  It is built with a single pass over the transactions and
+# money flows (see BasicInfo.build_monthly_rollup()), and can be saved
+# to and loaded from a sidecar SQLite file.  Month arguments are
+# YYYYMM integers, and all amounts returned are in dollars.
+class MonthlyRollup:
+    def __init__(self, account_openings, account_cells, bucket_openings, bucket_cells, source = None):
+        # What the rollup was built from (see rollup_source()), if it
+        # is known.
+        self.source = source
+
+        self.account_series = {}
+        for account in set(account_openings.keys()) | set(account_cells.keys()):
+            self.account_series[account] = MonthlySeries(account_openings.get(account, 0),
+                                                         account_cells.get(account, {}))
+
+        self.bucket_series = {}
+        for bucket in set(bucket_openings.keys()) | set(bucket_cells.keys()):
+            self.bucket_series[bucket] = MonthlySeries(bucket_openings.get(bucket, 0),
+                                                       bucket_cells.get(bucket, {}))
+
+    # Returns the first and last months that have any activity, or
+    # None if there is no activity at all.
+    def month_range(self):
+        months = [month for series in self.account_series.values() + self.bucket_series.values()
+                  for month in series.months[:1] + series.months[-1:]]
+        if not months:
+            return None
+        return (min(months), max(months))
+
+    # Returns the balance of the account at the end of the month.
+    def account_balance(self, account, month):
+        if account not in self.account_series:
+            return 0.0
+        return cents_to_amount(self.account_series[account].balance(month))
+
+    # Returns the balance of the bucket at the end of the month.
+    def bucket_balance(self, bucket, month):
+        if bucket not in self.bucket_series:
+            return 0.0
+        return cents_to_amount(self.bucket_series[bucket].balance(month))
+
+    # Returns a tuple of (activity, inflow, outflow) for the account
+    # over the first through last months (inclusive).
+    def account_activity(self, account, first_month, last_month):
+        if account not in self.account_series:
+            return (0.0, 0.0, 0.0)
+        return tuple(map(cents_to_amount, self.account_series[account].totals(first_month, last_month)))
+
+    # Returns a tuple of (activity, inflow, outflow) for the bucket
+    # over the first through last months (inclusive).
+    def bucket_activity(self, bucket, first_month, last_month):
+        if bucket not in self.bucket_series:
+            return (0.0, 0.0, 0.0)
+        return tuple(map(cents_to_amount, self.bucket_series[bucket].totals(first_month, last_month)))
+
+    # Returns the sum of the balances of the listed accounts at the
+    # end of the month.
+    def total_account_balance(self, accounts, month):
+        return cents_to_amount(sum([self.account_series[account].balance(month)
+                                    for account in accounts if account in self.account_series]))
+
+    # Returns the sum of the balances of all buckets at the end of the
+    # month.
+    def total_bucket_balance(self, month):
+        return cents_to_amount(sum([series.balance(month) for series in self.bucket_series.values()]))
+
+    # Saves the rollup to a sidecar SQLite file, replacing any rollup
+    # that was previously saved there.
+    def save(self, filename):
+        con = sqlite3.connect(filename)
+        con.execute('drop table if exists rollup_info')
+        con.execute('drop table if exists rollup_opening')
+        con.execute('drop table if exists rollup_cell')
+        con.execute('create table rollup_info (source text)')
+        con.execute('insert into rollup_info values (?)', (self.source,))
+        con.execute('create table rollup_opening (kind text, key integer, balance integer)')
+        con.execute('create table rollup_cell (kind text, key integer, month integer, activity integer, inflow integer, outflow integer)')
+        for kind, all_series in (('account', self.account_series), ('bucket', self.bucket_series)):
+            for key, series in all_series.items():
+                con.execute('insert into rollup_opening values (?,?,?)', (kind, key, series.opening_balance))
+                con.executemany('insert into rollup_cell values (?,?,?,?,?,?)',
+                                [(kind, key) + cell for cell in series.cells()])
+        con.commit()
+        con.close()
+
+    # Loads a rollup that was previously saved with save().
+    @staticmethod
+    def load(filename):
+        if not os.path.exists(filename):
+            raise Exception('no rollup %s' % (filename))
+        con = sqlite3.connect(filename)
+
+        source = None
+        if con.execute("select name from sqlite_master where type='table' and name='rollup_info'").fetchone():
+            source = con.execute('select source from rollup_info').fetchone()[0]
+
+        openings = { 'account': {}, 'bucket': {} }
+        for row in con.execute('select kind,key,balance from rollup_opening'):
+            openings[row[0]][row[1]] = row[2]
+
+        cells = { 'account': {}, 'bucket': {} }
+        for row in con.execute('select kind,key,month,activity,inflow,outflow from rollup_cell'):
+            cells[row[0]].setdefault(row[1], {})[row[2]] = list(row[3:])
+
+        con.close()
+        return MonthlyRollup(openings['account'], cells['account'], openings['bucket'], cells['bucket'], source)
+
+# Returns a string identifying the state of a document that a rollup
+# is built from: the path and store_stamp() of the file its data is in
+# (see document_store_path()) and the date its history is sealed to if
+# 'info' was read in from a checkpoint.
+def rollup_source(filename, info):
+    path = os.path.abspath(document_store_path(filename))
+    sealed = None
+    if info.checkpoint is not None:
+        sealed = info.checkpoint.sealed.isoformat()
+    return json.dumps([path, store_stamp(path), sealed])
+
+# Returns the monthly rollup of a document, loading it from the
+# sidecar 'rollup_filename' if it was saved there from the document as
+# it is now, and otherwise building it from 'info' and saving it
+# there for next time.
+def read_in_rollup(info, filename, rollup_filename):
+    source = rollup_source(filename, info)
+    if os.path.exists(rollup_filename):
+        rollup = MonthlyRollup.load(rollup_filename)
+        if rollup.source == source:
+            return rollup
+
+    rollup = info.build_monthly_rollup()
+    rollup.source = source
+    rollup.save(rollup_filename)
+    return rollup
+
+# Running balances of a set of accounts or buckets, indexed by date.
+# 'openings' is a dictionary of the balance (in cents) of each key
+# before any of its entries, and 'entries' is a dictionary mapping
+# each key to a list of (date, cents) tuples in any order.  The
+# balance of any key as of any date is then a binary search.
+class BalanceLedger:
+    def __init__(self, openings, entries):
+        self.openings = openings
+        self.dates = {}
+        self.totals = {}
+        for key, items in entries.items():
+            items = sorted(items)
+            dates = []
+            totals = [0]
+            for date, cents in items:
+                if dates and dates[-1] == date:
+                    totals[-1] += cents
+                else:
+                    dates.append(date)
+                    totals.append(totals[-1] + cents)
+            self.dates[key] = dates
+            self.totals[key] = totals
+
+    def keys(self):
+        return set(self.openings.keys()) | set(self.dates.keys())
+
+    # Returns the balance in cents of the key at the end of the date
+    # (or after all of its entries if date was not specified).
+    def balance_cents(self, key, date = datetime.date.max):
+        balance = self.openings.get(key, 0)
+        if key in self.dates:
+            balance += self.totals[key][bisect.bisect_right(self.dates[key], date)]
+        return balance
+
+    # Returns the balance in dollars of the key at the end of the date
+    # (or after all of its entries if date was not specified).
+    def balance(self, key, date = datetime.date.max):
+        return cents_to_amount(self.balance_cents(key, date))
+
+
 # Describes a data file.  Contains a list of accounts, a list of
 # buckets, the cash flow start date (as a datetime.date object), a
 # list of initial bucket balances, the list of transactions and the
-# list of money flows (aka bucket transfers).
+# list of money flows (aka bucket transfers).  If only the part of
+# the data file after a Checkpoint was read in, 'checkpoint' is the
+# Checkpoint that the balances start from and
+# 'reference_transactions' holds the transactions before it that
+# later ones refer to (see DataFile.get_reference_transactions()),
+# which can be looked up but are not otherwise included.
 class BasicInfo:
-    def __init__(self, accounts, buckets, cash_flow_start, starting_bucket_balances, transactions, money_flows):
+    def __init__(self, accounts, buckets, cash_flow_start, starting_bucket_balances, transactions, money_flows,
+                 checkpoint = None, reference_transactions = None):
         self.accounts = accounts
         self.buckets = buckets
         self.cash_flow_start = cash_flow_start
         self.starting_bucket_balances = starting_bucket_balances
         self.transactions = transactions
         self.money_flows = money_flows
+        self.checkpoint = checkpoint
+        if reference_transactions is None:
+            reference_transactions = {}
+        self.reference_transactions = reference_transactions
 
         # Create a set containing the keys of all split transactions.
         # The only way to find this out is to look for transactions
         # that have a "split_parent".
-        split_children = [txn for txn in transactions.values() if txn.split_parent]
+        split_children = [txn for txn in transactions.values() + reference_transactions.values() if txn.split_parent]
         self.splits = set(map(lambda txn: txn.split_parent, split_children))
 
+        # The children of each split transaction, keyed by the parent.
+        self.split_children = {}
+        for txn in split_children:
+            self.split_children.setdefault(txn.split_parent, []).append(txn)
+
         # Some accounts are bucketed for some of the history and not
         # for other parts.  It's OK for accounts to transition between
         # bucketed and unbucketed when their balances are 0.  This is
@@ -232,11 +533,27 @@ class BasicInfo:
         # the account was bucketed.
         self.semi_bucketed_accounts = {}
 
+        # How many days apart two otherwise identical transactions can
+        # be and still be considered duplicates of each other.
+        self.duplicate_date_tolerance = 3
+
+        # The rules behind most of the checks: the built-in
+        # CHECK_RULES and any added by add_check_rule().
+        self.check_rules = list(CHECK_RULES)
+        self._compiled_check_rules = None
+        self._rule_matches = None
+
+        # Baseline results used by what-if evaluations, built the
+        # first time they are needed (see check_state()).
+        self._check_state = None
+
     def add_account_bucketed_daterange(self, account, date_range):
         if account in self.semi_bucketed_accounts:
             self.semi_bucketed_accounts[account].append(date_range)
         else:
             self.semi_bucketed_accounts[account] = [date_range]
+        self._rule_matches = None
+        self._check_state = None
 
     def print_sometimes_bucketed_accounts(self):
         if len(self.semi_bucketed_accounts.keys()):
@@ -251,6 +568,18 @@ class BasicInfo:
             transaction = transaction.key
         return transaction in self.splits
 
+    # Returns the transaction with the specified key, or None if there
+    # is no such transaction.
+    def get_txn(self, key):
+        txn = self.transactions.get(key)
+        if txn is None:
+            return self.reference_transactions.get(key)
+        return txn
+
+    # Returns the children of a split transaction given its key
+    def split_children_of(self, key):
+        return self.split_children.get(key, [])
+
     # Returns the ID of an account given its name.  Returns None if
     # account with that name was not found.
     def account_id_from_name(self, account_name):
@@ -302,6 +631,12 @@ class BasicInfo:
         if date:
             txns = txns_at_or_before_date(txns, date)
 
+        if self.checkpoint is not None:
+            if date and date < self.checkpoint.sealed:
+                return cents_to_amount(self.checkpoint.account_balance_cents(account, date))
+            opening = self.checkpoint.account_balance_cents(account, self.checkpoint.sealed)
+            return cents_to_amount(opening + amount_to_cents(txn_amount_sum(txns)))
+
         return txn_amount_sum(txns)
 
     # Returns a sum of the balances of all specified accounts as of
@@ -333,6 +668,13 @@ class BasicInfo:
         else:
             starting_balance = 0
 
+        # If the history is sealed in a checkpoint, start from the
+        # balance on the sealed date instead.
+        if self.checkpoint is not None:
+            if date < self.checkpoint.sealed:
+                return cents_to_amount(self.checkpoint.bucket_balance_cents(bucket, date))
+            starting_balance = cents_to_amount(self.checkpoint.bucket_balance_cents(bucket, self.checkpoint.sealed))
+
         # Next, calculate the sum of all transactions that are
         # assigned to this bucket.  Note that we can only consider
         # transactions that are on or after the cash flow start date.
@@ -350,11 +692,130 @@ class BasicInfo:
 
         return round(sum(balances), 2)
 
+    # Returns a tuple of dictionaries of the balance (in cents) of each
+    # account and each bucket before any of the transactions and money
+    # flows that were read in: 0 and the starting bucket balances, or
+    # the balances on the sealed date of the checkpoint.  If not
+    # 'sealed', the balances before the checkpoint's history are
+    # returned instead.
+    def balance_openings(self, sealed = True):
+        if sealed and self.checkpoint is not None:
+            sealed = self.checkpoint.sealed
+            return (dict([(account, self.checkpoint.account_balance_cents(account, sealed)) for account in self.accounts.keys()]),
+                    dict([(bucket, self.checkpoint.bucket_balance_cents(bucket, sealed)) for bucket in self.buckets.keys()]))
+
+        account_openings = dict([(account, 0) for account in self.accounts.keys()])
+        bucket_openings = dict([(bucket, 0) for bucket in self.buckets.keys()])
+        for bucket, balance in self.starting_bucket_balances.items():
+            bucket_openings[bucket] = amount_to_cents(balance)
+        return (account_openings, bucket_openings)
+
+    # Returns a tuple of dictionaries of the monthly cells of each
+    # account and each bucket (see MonthlySeries) built with a single
+    # pass over the transactions and money flows on or before
+    # 'dateend'.  If the history is sealed in a checkpoint, the cells
+    # start out with those of the sealed history.
+    def monthly_cells(self, dateend = datetime.date.max):
+        def add_to_cell(cells, key, month, cents):
+            if key not in cells:
+                cells[key] = {}
+            if month not in cells[key]:
+                cells[key][month] = [0, 0, 0]
+            cell = cells[key][month]
+            cell[0] += cents
+            if cents > 0:
+                cell[1] += cents
+            else:
+                cell[2] += cents
+
+        account_cells = {}
+        bucket_cells = {}
+        if self.checkpoint is not None:
+            for cells, sealed_cells in ((account_cells, self.checkpoint.account_cells),
+                                        (bucket_cells, self.checkpoint.bucket_cells)):
+                for key, months in sealed_cells.items():
+                    cells[key] = dict([(month, list(cell)) for month, cell in months.items()])
+
+        for txn in self.transactions.values():
+            if txn.date > dateend:
+                continue
+            cents = amount_to_cents(txn.amount)
+            month = month_from_date(txn.date)
+
+            # Split children are only counted against the account
+            # through their parent, but it is the children that carry
+            # the buckets.
+            if txn.split_parent is None:
+                add_to_cell(account_cells, txn.account, month, cents)
+            if txn.bucket is not None and txn.date >= self.cash_flow_start:
+                add_to_cell(bucket_cells, txn.bucket, month, cents)
+
+        for flow in self.money_flows.values():
+            if self.cash_flow_start <= flow.date <= dateend:
+                add_to_cell(bucket_cells, flow.bucket, month_from_date(flow.date), amount_to_cents(flow.amount))
+
+        return (account_cells, bucket_cells)
+
+    # Builds a MonthlyRollup of the activity and balances of every
+    # account and bucket with a single pass over the transactions and
+    # money flows.  The balances it reports agree with
+    # account_balance() and bucket_balance() at the end of each month,
+    # including the months sealed in a checkpoint.
+    def build_monthly_rollup(self):
+        account_cells, bucket_cells = self.monthly_cells()
+        account_openings, bucket_openings = self.balance_openings(sealed = False)
+
+        return MonthlyRollup(account_openings, account_cells, bucket_openings, bucket_cells)
+
+    # Builds BalanceLedgers for the accounts and buckets with a single
+    # pass over the transactions and money flows.  Returns a tuple of
+    # (account ledger, bucket ledger) whose balances agree with
+    # account_balance() and bucket_balance() on every date.
+    def build_balance_ledgers(self):
+        account_entries = {}
+        bucket_entries = {}
+
+        for txn in self.transactions.values():
+            cents = amount_to_cents(txn.amount)
+            if txn.split_parent is None:
+                account_entries.setdefault(txn.account, []).append((txn.date, cents))
+            if txn.bucket is not None and txn.date >= self.cash_flow_start:
+                bucket_entries.setdefault(txn.bucket, []).append((txn.date, cents))
+
+        for flow in self.money_flows.values():
+            if flow.date >= self.cash_flow_start:
+                bucket_entries.setdefault(flow.bucket, []).append((flow.date, amount_to_cents(flow.amount)))
+
+        account_openings, bucket_openings = self.balance_openings()
+
+        return (BalanceLedger(account_openings, account_entries),
+                BalanceLedger(bucket_openings, bucket_entries))
+
+    # Print the month-end balances of the bucketed accounts and the
+    # buckets for every month covered by the rollup, to help find the
+    # month where they first stopped matching.
+    def print_monthly_balances(self, rollup):
+        month_range = rollup.month_range()
+        if not month_range:
+            return
+
+        print 'Month-end balances of bucketed accounts and buckets:'
+        month = max(month_range[0], month_from_date(self.cash_flow_start))
+        while month <= month_range[1]:
+            date = month_end_date(month)
+            account_sum = rollup.total_account_balance(self.bucketed_accounts(date), month)
+            bucket_sum = rollup.total_bucket_balance(month)
+            flag = ''
+            if account_sum != bucket_sum:
+                flag = '  *** differ by %.2f' % (account_sum - bucket_sum)
+            print '  %04d-%02d: accounts %12.2f  buckets %12.2f%s' % (month / 100, month % 100, account_sum, bucket_sum, flag)
+            month = next_month(month)
+
     # Check that the sum of the bucket starting balances matches the
     # balance of the listed accounts on the cash flow start date.  If
     # no accounts are specified, this will use the accounts that are
     # 'bucketed'.
-    def check_cash_flow_start(self, accounts_to_include = None):
+    def check_cash_flow_start(self, accounts_to_include = None, out = None):
         if accounts_to_include == None:
             accounts_to_include = self.bucketed_accounts(self.cash_flow_start)
 
@@ -366,23 +827,23 @@ class BasicInfo:
         account_balance_total = round(sum(map(lambda ab: ab[1], account_balances)), 2)
 
         if account_balance_total == bucket_balance_total:
-            print 'Cash flow start check: good (%.2f == %.2f)' % (bucket_balance_total, account_balance_total)
+            print >>out, 'Cash flow start check: good (%.2f == %.2f)' % (bucket_balance_total, account_balance_total)
         else:
-            print '  ***'
+            print >>out, '  ***'
             if account_balance_total > bucket_balance_total:
-                print '  *** ERROR: accounts exceed bucket balance at cash flow start date by %.2f' % (account_balance_total - bucket_balance_total)
+                print >>out, '  *** ERROR: accounts exceed bucket balance at cash flow start date by %.2f' % (account_balance_total - bucket_balance_total)
             else:
-                print '  *** ERROR: buckets exceed account balance at cash flow start date by %.2f' % (bucket_balance_total - account_balance_total)
-            print '  ***'
-            print '  *** Cash flow start date: %s' % (self.cash_flow_start.isoformat())
-            print '  *** Sum of bucket balances at cash flow start: %.2f' % (bucket_balance_total)
-            print '  *** Sum of account balances at cash flow start: %.2f' % (account_balance_total)
-            print '  ***'
-            print '  *** Account balances on cash flow start date:'
+                print >>out, '  *** ERROR: buckets exceed account balance at cash flow start date by %.2f' % (bucket_balance_total - account_balance_total)
+            print >>out, '  ***'
+            print >>out, '  *** Cash flow start date: %s' % (self.cash_flow_start.isoformat())
+            print >>out, '  *** Sum of bucket balances at cash flow start: %.2f' % (bucket_balance_total)
+            print >>out, '  *** Sum of account balances at cash flow start: %.2f' % (account_balance_total)
+            print >>out, '  ***'
+            print >>out, '  *** Account balances on cash flow start date:'
             for account_balance in account_balances:
                 account = account_balance[0]
                 balance = account_balance[1]
-                print '  ***   %d: %.2f (%s)' % (account, balance, self.accounts[account].name)
+                print >>out, '  ***   %d: %.2f (%s)' % (account, balance, self.accounts[account].name)
 
         return account_balance_total - bucket_balance_total
 
@@ -413,19 +874,19 @@ class BasicInfo:
     # Return true if this transaction is a transfer and the other side
     # of the transaction is going into (or out of) a bucketed account.
     def is_txn_xfer_sibling_bucketed(self, txn):
-        if txn.transfer_sibling not in self.transactions:
+        sibling = self.get_xfer_sibling(txn)
+        if sibling is None:
             return False # Not a transfer or missing sibling
 
-        sibling = self.transactions[txn.transfer_sibling]
         return self.is_account_bucketed(sibling.account, txn.date)
 
 
     # Given a transaction return its transfer sibling.
     def get_xfer_sibling(self, txn):
-        if txn.transfer_sibling not in self.transactions:
+        if not txn.transfer_sibling:
             return None
 
-        return self.transactions[txn.transfer_sibling]
+        return self.get_txn(txn.transfer_sibling)
 
     # The following methods are designed to catch entry errors that
     # would lead to the sum of bucket balances not equaling account
@@ -438,142 +899,167 @@ class BasicInfo:
     # unbucketed account, the error would be negative.
 
 
-    # Print out a list of all transactions in bucketed accounts that
-    # don't have buckets assigned.
-    def check_for_unbucketed_txns_in_bucketed_accounts(self):
-        error_sum = 0.0
-
-        for account in set(self.permanently_bucketed_accounts()) | set(self.sometimes_bucketed_accounts()):
-            # Start with a list of all transactions in this account starting on the cash flow start date
-            txns = txns_in_account(self.transactions, account)
-            txns = txns_between_dates(txns, self.cash_flow_start + datetime.timedelta(days=1), datetime.date.max)
-
-            if account in self.sometimes_bucketed_accounts():
-                # Only include transactions during the time(s) the account was bucketed
-                txns = [txn for txn in txns if self.is_account_bucketed(account, txn.date)]
-
-            # Exclude any split parent transactions
-            txns = [txn for txn in txns if not self.is_txn_split(txn)]
-
-            # Exclude any transfers
-            txns = [txn for txn in txns if not txn.transfer_sibling]
-
-            # Filter out all transactions that have a bucket assigned
-            txns = [txn for txn in txns if txn.bucket == None]
-
-            # Filter out transactions with an amount of 0 (since these won't impact balances anyway)
-            txns = [txn for txn in txns if txn.amount]
+    # Adds a site-specific CheckRule, which is then reported by (and
+    # adds to the error of) the check it names.  Rules for check_splits
+    # must measure the 'unsplit_amount', and rules for the other checks
+    # the 'amount'.
+    def add_check_rule(self, rule):
+        if rule.check not in TXN_CHECKS:
+            raise Exception('rule for unknown check %s' % (rule.check))
+        if (rule.check == 'check_splits') != (rule.value == 'unsplit_amount'):
+            raise Exception('a rule for %s cannot measure the %s' % (rule.check, rule.value))
+        self.check_rules.append(rule)
+        self._compiled_check_rules = None
+        self._rule_matches = None
+        self._check_state = None
+
+    # Returns the check rules compiled together (see CompiledCheckRules)
+    def compiled_check_rules(self):
+        if self._compiled_check_rules is None:
+            self._compiled_check_rules = CompiledCheckRules(self.check_rules)
+        return self._compiled_check_rules
+
+    # Returns the transactions that break each of the check rules,
+    # found with a single pass over the transactions.  This is a list
+    # with an entry for each rule in check_rules, which is a list of
+    # (transaction, error in cents, counted) tuples (see
+    # CompiledCheckRules.match()).
+    def check_rule_matches(self):
+        if self._rule_matches is None:
+            compiled = self.compiled_check_rules()
+            matches = [[] for rule in self.check_rules]
+            for txn in self.transactions.values():
+                for index, cents, counted in compiled.match(self, txn):
+                    matches[index].append((txn, cents, counted))
+            self._rule_matches = matches
+        return self._rule_matches
+
+    # Prints the transactions that break the rules for a check, by
+    # account and then by rule, and returns the sum of the errors.
+    def report_rule_check(self, check, summary, out = None):
+        indexes = [i for i in range(len(self.check_rules)) if self.check_rules[i].check == check]
+        matches = self.check_rule_matches()
+
+        # Only go through the accounts the rules could apply to, in
+        # the same order as the checks always have.
+        bucketed = set([self.check_rules[i].when.get('bucketed') for i in indexes])
+        if bucketed == set([True]):
+            accounts = set(self.permanently_bucketed_accounts()) | set(self.sometimes_bucketed_accounts())
+        elif bucketed == set([False]):
+            accounts = set(self.permanently_unbucketed_accounts()) | set(self.sometimes_bucketed_accounts())
+        else:
+            accounts = self.accounts.keys()
 
-            # Sort them by date
-            txns.sort(key = Transaction.get_date)
+        by_account = {}
+        for i in indexes:
+            for match in matches[i]:
+                by_account.setdefault((i, match[0].account), []).append(match)
 
-            if txns:
-                error_this_account = txn_amount_sum(txns)
-                error_sum += error_this_account
-                print '  ***'
-                print '  *** Bucketed account %d (%s) has %d transaction(s) without buckets totalling %.2f:' % \
-                    (account, self.accounts[account].name, len(txns), error_this_account)
-                for txn in txns:
-                    print '  *** %s' % (txn)
-                print '  ***'
+        error_sum = 0.0
+        for account in accounts:
+            for i in indexes:
+                rule = self.check_rules[i]
+                account_matches = by_account.get((i, account), [])
+                if not account_matches:
+                    continue
+
+                # Sort them by date
+                account_matches.sort(key = lambda match: match[0].date)
+
+                error_this_account = cents_to_amount(sum([cents for txn, cents, counted in account_matches]))
+                error_sum += rule.sign * cents_to_amount(sum([cents for txn, cents, counted in account_matches if counted]))
+                print >>out, '  ***'
+                print >>out, ('  *** ' + rule.message) % (account, self.accounts[account].name, len(account_matches), error_this_account)
+                for txn, cents, counted in account_matches:
+                    print >>out, '  *** %s' % (txn)
+                    if rule.show_sibling:
+                        sibling = self.get_xfer_sibling(txn)
+                        if sibling:
+                            print >>out, '  ***** ^-> %s' % (sibling)
+                            print >>out, '  *****'
+                print >>out, '  ***'
+
+        error_sum += self.print_sealed_check_error(check, out)
 
         if error_sum:
-            print '  *** Sum of unbucketed transactions in bucketed accounts: %.2f' % (error_sum)
+            print >>out, '  *** %s: %.2f' % (summary, error_sum)
         else:
-            print '  No issues found.'
+            print >>out, '  No issues found.'
 
         return error_sum
 
-    # Print out a list of all transactions in unbucketed accounts that
-    # have buckets assigned.
-    def check_for_bucketed_txns_in_unbucketed_accounts(self):
-        error_sum = 0.0
-
-        for account in set(self.permanently_unbucketed_accounts()) | set(self.sometimes_bucketed_accounts()):
-
-            # Start with a list of all transactions in this account starting on the cash flow start date
-            txns = txns_in_account(self.transactions, account)
-            txns = txns_between_dates(txns, self.cash_flow_start + datetime.timedelta(days=1), datetime.date.max)
-
-            if account in self.sometimes_bucketed_accounts():
-                # Only include transactions during the time(s) the account was unbucketed
-                txns = [txn for txn in txns if not self.is_account_bucketed(account, txn.date)]
-
-            # Exclude any split parent transactions
-            txns = [txn for txn in txns if not self.is_txn_split(txn)]
-
-            # Exclude any transfers
-            txns = [txn for txn in txns if not txn.transfer_sibling]
-
-            # Filter out all transactions that do not have a bucket assigned
-            txns = [txn for txn in txns if txn.bucket != None]
-
-            # Filter out transactions with an amount of 0 (since these won't impact balances anyway)
-            txns = [txn for txn in txns if txn.amount]
-
-            # Sort them by date
-            txns.sort(key = Transaction.get_date)
+    # Prints the error that a check found in the history sealed in the
+    # checkpoint, if any, and returns it.
+    def print_sealed_check_error(self, check, out = None):
+        if self.checkpoint is None or not self.checkpoint.check_errors.get(check):
+            return 0.0
 
-            if txns:
-                error_this_account = txn_amount_sum(txns)
-                error_sum += error_this_account
-                print '  ***'
-                print '  *** Unbucketed account %d (%s) has %d transaction(s) with buckets totalling %.2f:' % \
-                    (account, self.accounts[account].name, len(txns), error_this_account)
-                for txn in txns:
-                    print '  *** %s' % (txn)
-                print '  ***'
+        error = cents_to_amount(self.checkpoint.check_errors[check])
+        print >>out, '  ***'
+        print >>out, '  *** Errors in the history sealed up to %s: %.2f' % (self.checkpoint.sealed.isoformat(), error)
+        print >>out, '  ***'
+        return error
 
-        # See the above note about the sign of errors reported by this method
-        error_sum = -error_sum
-
-        if error_sum:
-            print '  *** Sum of bucketed transactions in unbucketed accounts: %.2f' % (error_sum)
-        else:
-            print '  No issues found.'
+    # Print out a list of all transactions in bucketed accounts that
+    # don't have buckets assigned.
+    def check_for_unbucketed_txns_in_bucketed_accounts(self, out = None):
+        return self.report_rule_check('check_for_unbucketed_txns_in_bucketed_accounts',
+                                      'Sum of unbucketed transactions in bucketed accounts', out)
 
-        return error_sum
+    # Print out a list of all transactions in unbucketed accounts that
+    # have buckets assigned.
+    def check_for_bucketed_txns_in_unbucketed_accounts(self, out = None):
+        return self.report_rule_check('check_for_bucketed_txns_in_unbucketed_accounts',
+                                      'Sum of bucketed transactions in unbucketed accounts', out)
 
     # Check that all splits have split children that add up to the split parent.
-    def check_splits(self):
+    def check_splits(self, out = None):
         error_sum = 0.0
         error_sum_bucketed = 0.0
         error_count = 0
 
+        matches = self.check_rule_matches()
+        unsplit = {}
+        for i in range(len(self.check_rules)):
+            if self.check_rules[i].check == 'check_splits':
+                for txn, cents, counted in matches[i]:
+                    unsplit.setdefault(txn.key, (cents, counted))
+
         for txn_key in self.splits:
-            parent = self.transactions[txn_key]
-            if parent.date < self.cash_flow_start:
-                # We don't need to check splits before the cash flow
-                # start date - they do not affect bucket balances.
+            if txn_key not in unsplit:
                 continue
-            children = [txn for txn in self.transactions.values() if txn.split_parent == txn_key]
-
-            error = parent.amount - txn_amount_sum(children)
-
-            if abs(error) >= 0.005:
-                print '  ***'
-                print '  *** Incomplete split transation (unsplit amount is %.2f):' % (error)
-                print '  ***   Parent:'
-                print '  ***     %s' % (parent)
-                print '  ***'
-                print '  ***   Children:'
-                for child in children:
-                    print '  ***     %s' % (child)
-                print '  ***'
-                error_count += 1
-                error_sum += error
-                if self.is_account_bucketed(parent.account, parent.date) and parent.date > self.cash_flow_start:
-                    error_sum_bucketed += error
+            parent = self.transactions[txn_key]
+            children = self.split_children_of(txn_key)
+            cents, counted = unsplit[txn_key]
+            error = cents_to_amount(cents)
+
+            print >>out, '  ***'
+            print >>out, '  *** Incomplete split transation (unsplit amount is %.2f):' % (error)
+            print >>out, '  ***   Parent:'
+            print >>out, '  ***     %s' % (parent)
+            print >>out, '  ***'
+            print >>out, '  ***   Children:'
+            for child in children:
+                print >>out, '  ***     %s' % (child)
+            print >>out, '  ***'
+            error_count += 1
+            error_sum += error
+            if counted:
+                error_sum_bucketed += error
 
         if error_count:
-            print '  *** Found %d split transaction(s) with errors' % (error_count)
+            print >>out, '  *** Found %d split transaction(s) with errors' % (error_count)
         if error_sum:
-            print '  *** Total of errors: %.2f' % (error_sum)
+            print >>out, '  *** Total of errors: %.2f' % (error_sum)
+
+        sealed_error = self.print_sealed_check_error('check_splits', out)
+        error_sum_bucketed += sealed_error
+
         if error_sum_bucketed:
-            print '  *** Total of errors in bucketed accounts: %.2f' % (error_sum_bucketed)
+            print >>out, '  *** Total of errors in bucketed accounts: %.2f' % (error_sum_bucketed)
 
-        if error_count == 0:
-            print '  No issues found.'
+        if error_count == 0 and not sealed_error:
+            print >>out, '  No issues found.'
 
         # We return the error only as it applies to bucketed accounts.
         # Any unsplit portion in an unbucketed account does not affect
@@ -584,115 +1070,798 @@ class BasicInfo:
     # Check that transfers between bucketed accounts have no buckets
     # assigned, and that transfers between bucketed and unbucketed
     # accounts have buckets on the bucketed side.
-    def check_bucketed_account_transfers(self):
-        error_sum = 0.0
+    def check_bucketed_account_transfers(self, out = None):
+        return self.report_rule_check('check_bucketed_account_transfers',
+                                      'Sum of incorrect bucketed transfers in bucketed accounts', out)
 
-        for account in set(self.permanently_bucketed_accounts()) | set(self.sometimes_bucketed_accounts()):
-            # Get a list of all transfers in this account (after the cash flow start date)
-            txns = txns_in_account(self.transactions, account)
-            txns = txns_between_dates(txns, self.cash_flow_start + datetime.timedelta(days=1), datetime.date.max)
-
-            if account in self.sometimes_bucketed_accounts():
-                # Only include transactions during the time(s) the account was bucketed
-                txns = [txn for txn in txns if self.is_account_bucketed(account, txn.date)]
-                
-            xfers = [txn for txn in txns if txn.transfer_sibling]
-
-            # Split them into the ones going to bucketed and unbucketed accounts
-            xfers_to_bucketed = [txn for txn in xfers if self.is_txn_xfer_sibling_bucketed(txn)]
-            xfers_to_unbucketed = [txn for txn in xfers if not self.is_txn_xfer_sibling_bucketed(txn)]
-
-            # Get a list of all transfers to bucketed accounts that have buckets assigned (they shouldn't):
-            xfers_to_bucketed = [txn for txn in xfers_to_bucketed if txn.bucket]
-            xfers_to_bucketed.sort(key = Transaction.get_date)
-
-            # NOTE: all split transactions in bucketed accounts should be considered as bucketed here as their children
-            # have been checked as bucketed.
-
-            # Get a list of all transfers to unbucketed accounts that don't have buckets assigned (they should):
-            xfers_to_unbucketed = [txn for txn in xfers_to_unbucketed if not (txn.bucket or self.is_txn_split(txn))]
-            xfers_to_unbucketed.sort(key = Transaction.get_date)
-
-            if xfers_to_bucketed:
-                error_this_time = txn_amount_sum(xfers_to_bucketed)
-                error_sum += error_this_time
-                print '  ***'
-                print '  *** Bucketed account %d (%s) has %d transfer(s) to another bucketed account with buckets assigned totalling %.2f:' % \
-                    (account, self.accounts[account].name, len(xfers_to_bucketed), error_this_time)
-                for txn in xfers_to_bucketed:
-                    print '  *** %s' % (txn)
-                    sibling = self.get_xfer_sibling(txn)
-                    if sibling:
-                        print '  ***** ^-> %s' % (sibling)
-                        print '  *****'
-                print '  ***'
-
-            if xfers_to_unbucketed:
-                error_this_time = txn_amount_sum(xfers_to_unbucketed)
-                error_sum += error_this_time
-                print '  ***'
-                print '  *** Bucketed account %d (%s) has %d transfer(s) to unbucketed accounts without buckets assigned totalling %.2f:' % \
-                    (account, self.accounts[account].name, len(xfers_to_unbucketed), error_this_time)
-                for txn in xfers_to_unbucketed:
-                    print '  *** %s' % (txn)
-                    sibling = self.get_xfer_sibling(txn)
-                    if sibling:
-                        print '  ***** ^-> %s' % (sibling)
-                        print '  *****'
-                print '  ***'
+    # Check that transfers in unbucketed accounts have no buckets
+    # assigned - this is true whether the other side is a bucketed or
+    # unbucketed account.
+    def check_unbucketed_account_transfers(self, out = None):
+        return self.report_rule_check('check_unbucketed_account_transfers',
+                                      'Sum of bucketed transfers in unbucketed accounts', out)
+
+    # Print out groups of transactions that look like duplicates of
+    # each other (typically from importing the same download twice):
+    # the same amount in the same account with the same normalized
+    # payee, no more than 'max_days' days apart (the
+    # duplicate_date_tolerance by default) from the first transaction
+    # of the group.  Rather than comparing every pair of transactions,
+    # the first transaction of each group is hashed into a slot keyed
+    # on (account, amount in cents, date window, payee), and each
+    # transaction is only compared against those in its own slot and
+    # the slot for the window before it.
+    #
+    # The error returned is the sum of the extra copies that landed in
+    # bucketed accounts after the cash flow start date, which is how
+    # much those account balances are overstated.  Duplicates with
+    # buckets assigned overstate the buckets by the same amount, so
+    # this error overlaps the other checks rather than adding to them.
+    def check_for_duplicate_txns(self, max_days = None, out = None):
+        if max_days is None:
+            max_days = self.duplicate_date_tolerance
+        window = max_days + 1
+
+        slots = {}
+        groups = {}     # key of the first transaction -> list of duplicates
+        payees = {}     # payee -> normalized payee, since payees repeat a lot
+
+        txns = [txn for txn in proper_txns(self.transactions) if txn.amount]
+        txns.sort(key = lambda txn: (txn.date, txn.key))
+        for txn in txns:
+            day = txn.date.toordinal()
+            if txn.payee not in payees:
+                payees[txn.payee] = normalize_payee(txn.payee)
+            slot = (txn.account, amount_to_cents(txn.amount), day / window, payees[txn.payee])
+
+            match = None
+            for other_slot in (slot[:2] + (slot[2] - 1,) + slot[3:], slot):
+                for other in slots.get(other_slot, []):
+                    if day - other.date.toordinal() <= max_days:
+                        match = other
+                        break
+                if match:
+                    break
+
+            # A duplicate is only ever compared against the first
+            # transaction of its group, so that a chain of transactions
+            # a few days apart doesn't become one group.
+            if match:
+                groups.setdefault(match.key, []).append(txn)
+            else:
+                slots.setdefault(slot, []).append(txn)
 
-        if error_sum:
-            print '  *** Sum of incorrect bucketed transfers in bucketed accounts: %.2f' % (error_sum)
+        error_sum = 0.0
+        duplicate_sum = 0.0
+        duplicate_count = 0
+
+        for first in sorted(groups.keys(), key = lambda key: (self.transactions[key].date, key)):
+            original = self.transactions[first]
+            duplicates = groups[first]
+            duplicate_count += len(duplicates)
+            duplicate_sum += txn_amount_sum(duplicates)
+            for txn in duplicates:
+                if txn.date > self.cash_flow_start and txn.account in self.accounts and \
+                        self.is_account_bucketed(txn.account, txn.date):
+                    error_sum += txn.amount
+
+            if original.account in self.accounts:
+                account_name = self.accounts[original.account].name
+            else:
+                account_name = '?'
+            print >>out, '  ***'
+            print >>out, '  *** Account %s (%s) has %d possible duplicate(s) of a %.2f transaction:' % \
+                (original.account, account_name, len(duplicates), original.amount)
+            print >>out, '  *** %s' % (original)
+            for txn in duplicates:
+                print >>out, '  ***** ^-> %s' % (txn)
+            print >>out, '  ***'
+
+        error_sum = round(error_sum, 2)
+
+        if duplicate_count:
+            print >>out, '  *** Found %d possible duplicate transaction(s) totalling %.2f' % (duplicate_count, duplicate_sum)
+            if error_sum:
+                print >>out, '  *** Sum of possible duplicates in bucketed accounts: %.2f' % (error_sum)
         else:
-            print '  No issues found.'
+            print >>out, '  No issues found.'
 
         return error_sum
 
-    # Check that transfers in unbucketed accounts have no buckets
-    # assigned - this is true whether the other side is a bucketed or
-    # unbucketed account.
-    def check_unbucketed_account_transfers(self):
-        error_sum = 0.0
+    # Works out each period up to and including 'dateend' where a
+    # bucket's balance was negative at the end of the day, along with
+    # the transaction or money flow that took it there (the largest one
+    # out of the bucket on the day it went negative).  The daily
+    # balances of all of the buckets are worked out together: the
+    # transactions and money flows are totalled by bucket and day, and
+    # the days are then sorted once and run through keeping a running
+    # total for each bucket.
+    #
+    # Each interval is a list of [bucket, first date, last date (or
+    # None if it is still negative), trigger, lowest balance, date of
+    # the lowest balance].  Returns a tuple of the list of intervals
+    # that ended, a dictionary of the intervals still open at 'dateend'
+    # by bucket, and the balance (in cents) of each bucket then.
+    def negative_bucket_intervals(self, dateend = datetime.date.max):
+        account_openings, balances = self.balance_openings()
+
+        # Total the bucket transactions and money flows by bucket and
+        # day, keeping the largest one out of the bucket on each day.
+        days = {}
+        triggers = {}
+        for items in (self.transactions.values(), self.money_flows.values()):
+            for item in items:
+                if item.bucket in self.buckets and self.cash_flow_start <= item.date <= dateend:
+                    day = (item.bucket, item.date)
+                    cents = amount_to_cents(item.amount)
+                    days[day] = days.get(day, 0) + cents
+                    if cents < 0 and (day not in triggers or cents < triggers[day][0]):
+                        triggers[day] = (cents, item)
+
+        # The intervals of the history sealed in a checkpoint are kept
+        # in it, and those still open at the sealed date carry on from
+        # where they were.  Otherwise a bucket that opens negative is
+        # negative at the end of the cash flow start date unless it has
+        # activity that day, in which case that day's balance decides
+        # it below.
+        intervals = []
+        negative = {}
+        if self.checkpoint is not None and self.checkpoint.sealed >= self.cash_flow_start:
+            for interval in self.checkpoint.negative_intervals:
+                if interval[2] is None:
+                    negative[interval[0]] = list(interval)
+                else:
+                    intervals.append(list(interval))
+        else:
+            start = self.cash_flow_start
+            for bucket, cents in balances.items():
+                if cents < 0 and (bucket, start) not in days:
+                    negative[bucket] = [bucket, start, None, None, cents, start]
+
+        for day in sorted(days.keys()):
+            bucket, date = day
+            before = balances[bucket]
+            balances[bucket] += days[day]
+            interval = negative.get(bucket)
+            if balances[bucket] < 0:
+                if interval is None:
+                    # There is only no trigger if the bucket opened
+                    # negative.
+                    trigger = None
+                    if before >= 0:
+                        trigger = triggers[day][1]
+                    negative[bucket] = [bucket, date, None, trigger, balances[bucket], date]
+                elif balances[bucket] < interval[4]:
+                    interval[4] = balances[bucket]
+                    interval[5] = date
+            elif interval is not None:
+                interval[2] = date - datetime.timedelta(days=1)
+                intervals.append(interval)
+                del negative[bucket]
+
+        return (intervals, negative, balances)
+
+    # Print out each period where a bucket's balance was negative at
+    # the end of the day (see negative_bucket_intervals()).
+    #
+    # A bucket going negative doesn't make the accounts and buckets
+    # disagree, so this isn't an error in that sense.  The sum returned
+    # is of the buckets that are negative now.
+    def check_for_negative_intervals(self, out = None):
+        intervals, negative, balances = self.negative_bucket_intervals()
+        intervals = intervals + negative.values()
+        intervals.sort(key = lambda interval: (interval[1], interval[0]))
+
+        for bucket, first, last, trigger, lowest, lowest_date in intervals:
+            if last is None:
+                when = 'has been negative since %s' % (first.isoformat())
+            else:
+                when = 'was negative from %s to %s' % (first.isoformat(), last.isoformat())
+            if bucket in self.buckets:
+                bucket_name = self.buckets[bucket].name
+            else:
+                bucket_name = '?'
+            print >>out, '  ***'
+            print >>out, '  *** Bucket %d (%s) %s, reaching %.2f on %s:' % \
+                (bucket, bucket_name, when, cents_to_amount(lowest), lowest_date.isoformat())
+            if trigger is None:
+                print >>out, '  *** (its balance was already negative on %s)' % (first.isoformat())
+            else:
+                print >>out, '  *** %s' % (trigger)
+            print >>out, '  ***'
 
-        for account in set(self.permanently_unbucketed_accounts()) | set(self.sometimes_bucketed_accounts()):
+        error_sum = cents_to_amount(sum([balances[bucket] for bucket in negative.keys()]))
 
-            # Get a list of all transfers in this account (after the cash flow start date)
-            txns = txns_in_account(self.transactions, account)
-            txns = txns_between_dates(txns, self.cash_flow_start + datetime.timedelta(days=1), datetime.date.max)
+        if intervals:
+            print >>out, '  *** Found %d period(s) of negative balances in %d bucket(s)' % \
+                (len(intervals), len(set([interval[0] for interval in intervals])))
+            if error_sum:
+                print >>out, '  *** Sum of the buckets that are negative now: %.2f' % (error_sum)
+        else:
+            print >>out, '  No issues found.'
 
-            if account in self.sometimes_bucketed_accounts():
-                # Only include transactions during the time(s) the account was unbucketed
-                txns = [txn for txn in txns if not self.is_account_bucketed(account, txn.date)]
+        return error_sum
 
-            xfers = [txn for txn in txns if txn.transfer_sibling]
+    # Returns the baseline that what-if evaluations are measured
+    # against, building it with a single pass over the transactions
+    # the first time it is needed.  It holds the error each
+    # transaction contributes to each of the TXN_CHECKS, their totals,
+    # the balance ledgers and the transactions in each account.
+    def check_state(self):
+        if self._check_state is None:
+            state = CheckState()
+            state.account_ledger, state.bucket_ledger = self.build_balance_ledgers()
+            state.totals = [0] * len(TXN_CHECKS)
+            if self.checkpoint is not None:
+                state.totals = [self.checkpoint.check_errors.get(check, 0) for check in TXN_CHECKS]
+            matches = self.check_rule_matches()
+            for i in range(len(self.check_rules)):
+                rule = self.check_rules[i]
+                check = TXN_CHECKS.index(rule.check)
+                for txn, cents, counted in matches[i]:
+                    if counted and cents:
+                        errors = state.errors.setdefault(txn.key, [0] * len(TXN_CHECKS))
+                        errors[check] += rule.sign * cents
+                        state.totals[check] += rule.sign * cents
+
+            # Transactions sorted by date for each account, and the
+            # transfers whose sibling is in each account.
+            account_txns = {}
+            sibling_txns = {}
+            for txn in self.transactions.values():
+                account_txns.setdefault(txn.account, []).append((txn.date, txn.key))
+                sibling = self.get_txn(txn.transfer_sibling)
+                if sibling is not None:
+                    sibling_txns.setdefault(sibling.account, []).append((txn.date, txn.key))
+            for index, txns in ((state.account_txns, account_txns), (state.sibling_txns, sibling_txns)):
+                for account, items in txns.items():
+                    items.sort()
+                    index[account] = ([date for date, key in items], [key for date, key in items])
+
+            self._check_state = state
+        return self._check_state
+
+    # Returns the balance of an account (in cents) at the end of the
+    # day before the cash flow start date.
+    def cash_flow_start_balance_cents(self, account):
+        date = self.cash_flow_start - datetime.timedelta(days=1)
+        if self.checkpoint is not None and date < self.checkpoint.sealed:
+            return self.checkpoint.account_balance_cents(account, date)
+        return self.check_state().account_ledger.balance_cents(account, date)
+
+    # Returns a new WhatIf for trying out hypothetical edits to this
+    # document.
+    def what_if(self):
+        return WhatIf(self)
+
+# The checks whose errors can be worked out one transaction at a time,
+# in the order that txn_check_errors() returns them.
+TXN_CHECKS = [
+    'check_for_bucketed_txns_in_unbucketed_accounts',
+    'check_for_unbucketed_txns_in_bucketed_accounts',
+    'check_splits',
+    'check_bucketed_account_transfers',
+    'check_unbucketed_account_transfers',
+]
 
-            # Get a list of all transfers that have buckets assigned (they shouldn't):
-            xfers = [txn for txn in xfers if txn.bucket]
-            xfers.sort(key = Transaction.get_date)
+#
+# Check rules.  The TXN_CHECKS are described by rules about what a
+# transaction may not look like, rather than each being code that
+# goes through all of the transactions.  All of the rules are
+# compiled together, so the transactions are only gone through once
+# however many rules there are.
+#
 
-            if xfers:
-                error_this_time = txn_amount_sum(xfers)
-                error_sum += error_this_time
-                print '  ***'
-                print '  *** Unbucketed account %d (%s) has %d transfer(s) with buckets assigned totalling %.2f:' % \
-                    (account, self.accounts[account].name, len(xfers), error_this_time)
-                for txn in xfers:
-                    print '  *** %s' % (txn)
-                    sibling = self.get_xfer_sibling(txn)
-                    if sibling:
-                        print '  ***** ^-> %s' % (sibling)
-                        print '  *****'
-                print '  ***'
+# The features of a transaction that a CheckRule can test, each a bit
+# in the mask that CompiledCheckRules.features() returns:
+#
+#   after_cash_flow_start: it is dated after the cash flow start date
+#   from_cash_flow_start: it is dated on or after the cash flow start date
+#   has_bucket: it has a bucket assigned
+#   transfer: it is a transfer
+#   nonzero: its amount is not 0
+#   credit: its amount is positive
+#   split: it is a split parent
+#   bucketed: its account is bucketed on its date
+#   sibling_bucketed: its transfer sibling's account is bucketed on its date
+FEATURE_AFTER_CASH_FLOW_START = 1 << 0
+FEATURE_FROM_CASH_FLOW_START = 1 << 1
+FEATURE_HAS_BUCKET = 1 << 2
+FEATURE_TRANSFER = 1 << 3
+FEATURE_NONZERO = 1 << 4
+FEATURE_CREDIT = 1 << 5
+FEATURE_SPLIT = 1 << 6
+FEATURE_BUCKETED = 1 << 7
+FEATURE_SIBLING_BUCKETED = 1 << 8
+
+RULE_FEATURE_BITS = {
+    'after_cash_flow_start': FEATURE_AFTER_CASH_FLOW_START,
+    'from_cash_flow_start': FEATURE_FROM_CASH_FLOW_START,
+    'has_bucket': FEATURE_HAS_BUCKET,
+    'transfer': FEATURE_TRANSFER,
+    'nonzero': FEATURE_NONZERO,
+    'credit': FEATURE_CREDIT,
+    'split': FEATURE_SPLIT,
+    'bucketed': FEATURE_BUCKETED,
+    'sibling_bucketed': FEATURE_SIBLING_BUCKETED,
+}
+
+# The features that can be worked out from a transaction on its own,
+# without looking anything else up.
+CHEAP_FEATURES = FEATURE_AFTER_CASH_FLOW_START | FEATURE_FROM_CASH_FLOW_START | FEATURE_HAS_BUCKET | \
+    FEATURE_TRANSFER | FEATURE_NONZERO | FEATURE_CREDIT
+
+# Returns a tuple of (mask, bits) for a dictionary of features, such
+# that a transaction has those features if its feature mask ANDed
+# with 'mask' equals 'bits'.
+def rule_feature_mask(features):
+    mask = 0
+    bits = 0
+    for feature, value in features.items():
+        if feature not in RULE_FEATURE_BITS:
+            raise Exception('unknown check rule feature %s' % (feature))
+        mask |= RULE_FEATURE_BITS[feature]
+        if value:
+            bits |= RULE_FEATURE_BITS[feature]
+    return (mask, bits)
+
+# A rule that is broken by a transaction that has (or doesn't have)
+# every feature in 'when', a dictionary of RULE_FEATURES to True or
+# False.  It can also be limited to a DateRange and to amounts from
+# 'min_amount' to 'max_amount'.  Transactions in accounts that aren't
+# in the document never break a rule.
+#
+# 'check' is the name of the check (one of TXN_CHECKS) that reports
+# the rule.  'value' is how the error is measured: the 'amount' of the
+# transaction, or for split parents the 'unsplit_amount' not covered
+# by the children, in which case a transaction with nothing unsplit
+# doesn't break the rule.  'sign' is 1 or -1 to follow the
+# "account_balances - bucket_balances = error" convention.  The error
+# is only added to the check's sum if the transaction also has the
+# features in 'counted' (a dictionary like 'when').
+#
+# 'message' introduces the transactions in an account that break the
+# rule, and is formatted with the account's key and name, the number
+# of transactions and their total.  If 'show_sibling' is set, the
+# other side of each transfer is printed with it.
+class CheckRule:
+    def __init__(self, check, when, message = None, value = 'amount', sign = 1, counted = None,
+                 date_range = None, min_amount = None, max_amount = None, show_sibling = False):
+        if counted is None:
+            counted = {}
+        if value not in ('amount', 'unsplit_amount'):
+            raise Exception('unknown check rule value %s' % (value))
+        if sign not in (1, -1):
+            raise Exception('check rule sign must be 1 or -1')
+        self.check = check
+        self.when = when
+        self.message = message
+        self.value = value
+        self.sign = sign
+        self.counted = counted
+        self.date_range = date_range
+        self.min_amount = min_amount
+        self.max_amount = max_amount
+        self.show_sibling = show_sibling
+        self.limited = date_range is not None or min_amount is not None or max_amount is not None
+
+        self.mask, self.bits = rule_feature_mask(when)
+        self.counted_mask, self.counted_bits = rule_feature_mask(counted)
 
-        # See the note above about the sign of the error reported by these methods.
-        error_sum = -error_sum
+    def __repr__(self):
+        return 'CheckRule(%s, %s)' % (self.check, self.when)
+
+# The rules behind the TXN_CHECKS.  These only look at transactions
+# after the cash flow start date, since earlier transactions don't
+# affect bucket balances.
+CHECK_RULES = [
+    CheckRule('check_for_bucketed_txns_in_unbucketed_accounts',
+              { 'after_cash_flow_start': True, 'bucketed': False, 'split': False, 'transfer': False,
+                'has_bucket': True, 'nonzero': True },
+              'Unbucketed account %d (%s) has %d transaction(s) with buckets totalling %.2f:',
+              sign = -1),
+    CheckRule('check_for_unbucketed_txns_in_bucketed_accounts',
+              { 'after_cash_flow_start': True, 'bucketed': True, 'split': False, 'transfer': False,
+                'has_bucket': False, 'nonzero': True },
+              'Bucketed account %d (%s) has %d transaction(s) without buckets totalling %.2f:'),
+    # Splits on the cash flow start date are reported, but any
+    # unsplit amount only matters in a bucketed account after it.
+    CheckRule('check_splits',
+              { 'from_cash_flow_start': True, 'split': True },
+              value = 'unsplit_amount',
+              counted = { 'after_cash_flow_start': True, 'bucketed': True }),
+    CheckRule('check_bucketed_account_transfers',
+              { 'after_cash_flow_start': True, 'bucketed': True, 'transfer': True, 'sibling_bucketed': True,
+                'has_bucket': True },
+              'Bucketed account %d (%s) has %d transfer(s) to another bucketed account with buckets assigned totalling %.2f:',
+              show_sibling = True),
+    # A split transfer's buckets are on its children.
+    CheckRule('check_bucketed_account_transfers',
+              { 'after_cash_flow_start': True, 'bucketed': True, 'transfer': True, 'sibling_bucketed': False,
+                'has_bucket': False, 'split': False },
+              'Bucketed account %d (%s) has %d transfer(s) to unbucketed accounts without buckets assigned totalling %.2f:',
+              show_sibling = True),
+    CheckRule('check_unbucketed_account_transfers',
+              { 'after_cash_flow_start': True, 'bucketed': False, 'transfer': True, 'has_bucket': True },
+              'Unbucketed account %d (%s) has %d transfer(s) with buckets assigned totalling %.2f:',
+              sign = -1, show_sibling = True),
+]
+
+# A list of CheckRule's compiled so that a transaction can be matched
+# against all of them at once: its features are worked out once as a
+# bit mask, which is looked up in a table of the rules broken by each
+# mask.
+class CompiledCheckRules:
+    def __init__(self, rules):
+        self.rules = [(index, rule, TXN_CHECKS.index(rule.check)) for index, rule in enumerate(rules)]
+        self.rules_by_mask = {}
+
+        # The features every rule agrees on, so that transactions
+        # that can't break any rule (typically those before the cash
+        # flow start date) are passed over before the features that
+        # take lookups to work out.
+        self.common_mask = 0
+        self.common_bits = 0
+        if rules:
+            self.common_mask = reduce(lambda a, b: a & b, [rule.mask for rule in rules])
+            for rule in rules:
+                self.common_mask &= ~(rule.bits ^ rules[0].bits)
+            self.common_bits = rules[0].bits & self.common_mask
+        self.common_mask &= CHEAP_FEATURES
+        self.common_bits &= CHEAP_FEATURES
+
+        self.needs_bucketed = any([(rule.mask | rule.counted_mask) & FEATURE_BUCKETED for rule in rules])
+        self.needs_split = any([rule.mask & FEATURE_SPLIT or rule.value == 'unsplit_amount' for rule in rules])
+
+    # Returns the feature mask of a transaction, or None if it can't
+    # break any of the rules.  'view' is a BasicInfo, or a WhatIf to
+    # see the transaction with hypothetical edits applied.
+    def features(self, view, txn):
+        if txn.account not in view.accounts:
+            return None
 
-        if error_sum:
-            print '  *** Sum of bucketed transfers in unbucketed accounts: %.2f' % (error_sum)
+        mask = 0
+        if txn.date > view.cash_flow_start:
+            mask = FEATURE_AFTER_CASH_FLOW_START | FEATURE_FROM_CASH_FLOW_START
+        elif txn.date == view.cash_flow_start:
+            mask = FEATURE_FROM_CASH_FLOW_START
+        if txn.bucket is not None:
+            mask |= FEATURE_HAS_BUCKET
+        if txn.transfer_sibling:
+            mask |= FEATURE_TRANSFER
+        if txn.amount:
+            mask |= FEATURE_NONZERO
+            if txn.amount > 0:
+                mask |= FEATURE_CREDIT
+        if mask & self.common_mask != self.common_bits:
+            return None
+
+        if self.needs_split and view.is_txn_split(txn):
+            mask |= FEATURE_SPLIT
+        if self.needs_bucketed and view.is_account_bucketed(txn.account, txn.date):
+            mask |= FEATURE_BUCKETED
+        if txn.transfer_sibling:
+            sibling = view.get_txn(txn.transfer_sibling)
+            if sibling is not None and sibling.account in view.accounts and \
+                    view.is_account_bucketed(sibling.account, txn.date):
+                mask |= FEATURE_SIBLING_BUCKETED
+        return mask
+
+    # Returns a list of the rules the transaction breaks, as (index of
+    # the rule, error in cents, counted) tuples.  The error doesn't
+    # have the rule's sign applied.
+    def match(self, view, txn):
+        mask = self.features(view, txn)
+        if mask is None:
+            return []
+
+        # The rules that transactions with this mask break are only
+        # worked out the first time the mask is seen.
+        rules = self.rules_by_mask.get(mask)
+        if rules is None:
+            rules = [(index, rule, check) for index, rule, check in self.rules if mask & rule.mask == rule.bits]
+            self.rules_by_mask[mask] = rules
+
+        matches = []
+        for index, rule, check in rules:
+            if rule.limited:
+                if rule.date_range is not None and not rule.date_range.includes_date(txn.date):
+                    continue
+                if rule.min_amount is not None and txn.amount < rule.min_amount:
+                    continue
+                if rule.max_amount is not None and txn.amount > rule.max_amount:
+                    continue
+
+            cents = amount_to_cents(txn.amount)
+            if rule.value == 'unsplit_amount':
+                cents -= sum([amount_to_cents(child.amount) for child in view.split_children_of(txn.key)])
+                if not cents:
+                    continue
+            matches.append((index, cents, mask & rule.counted_mask == rule.counted_bits))
+        return matches
+
+    # Returns a list of the errors (in cents) that each of the
+    # TXN_CHECKS finds in a single transaction, with the same sign
+    # conventions as the check methods.
+    def errors(self, view, txn):
+        errors = [0] * len(TXN_CHECKS)
+        for index, cents, counted in self.match(view, txn):
+            if counted:
+                index, rule, check = self.rules[index]
+                errors[check] += rule.sign * cents
+        return errors
+
+# Returns a list of the errors (in cents) that each of the TXN_CHECKS
+# finds in a single transaction, with the same sign conventions as
+# the check methods.  'view' is a BasicInfo, or a WhatIf to see the
+# transaction with hypothetical edits applied.
+def txn_check_errors(view, txn):
+    return view.compiled_check_rules().errors(view, txn)
+
+# The baseline a WhatIf is evaluated against (see
+# BasicInfo.check_state()).  'account_txns' and 'sibling_txns' map an
+# account to a tuple of (dates, keys) lists sorted by date.
+class CheckState:
+    def __init__(self):
+        self.errors = {}
+        self.totals = []
+        self.account_txns = {}
+        self.sibling_txns = {}
+        self.account_ledger = None
+        self.bucket_ledger = None
+
+# A set of hypothetical edits to a document, applied as an overlay on
+# top of a BasicInfo without changing it (or the data file).  Make the
+# edits with the methods below, then call evaluate() to see what the
+# checks and balances would be.  Only the transactions affected by the
+# edits are re-checked, so an evaluation is quick even for a large
+# document once the baseline has been built.
+class WhatIf:
+    def __init__(self, info):
+        self.info = info
+        self.accounts = info.accounts
+        self.cash_flow_start = info.cash_flow_start
+
+        # Edited copies of transactions, keyed by transaction key
+        self.txn_overrides = {}
+
+        # Replacement lists of bucketed DateRange's, keyed by account
+        self.bucketed_overrides = {}
+
+    # Hypothetically assign a transaction to a bucket (or remove its
+    # bucket if 'bucket' is None).
+    def assign_bucket(self, txn_key, bucket):
+        txn = self.get_txn(txn_key)
+        if txn is None:
+            raise Exception('no transaction %s' % (txn_key))
+        if txn_key not in self.info.transactions:
+            raise Exception('transaction %s is sealed in the checkpoint' % (txn_key))
+        if bucket is not None and bucket not in self.info.buckets:
+            raise Exception('no bucket %s' % (bucket))
+        txn = copy.copy(txn)
+        txn.bucket = bucket
+        self.txn_overrides[txn_key] = txn
+
+    # Hypothetically mark an account as bucketed during a date range,
+    # in the same way as BasicInfo.add_account_bucketed_daterange().
+    # To mark an account as bucketed from a date on, use a date range
+    # that ends on datetime.date.max.
+    def add_account_bucketed_daterange(self, account, date_range):
+        if account not in self.accounts:
+            raise Exception('no account %s' % (account))
+        if self.info.checkpoint is not None and date_range.datestart <= self.info.checkpoint.sealed:
+            raise Exception('cannot change whether account %s was bucketed on or before the checkpoint on %s' %
+                            (account, self.info.checkpoint.sealed.isoformat()))
+        if account in self.bucketed_overrides:
+            ranges = self.bucketed_overrides[account]
         else:
-            print '  No issues found.'
+            ranges = self.info.semi_bucketed_accounts.get(account, [])
+        self.bucketed_overrides[account] = ranges + [date_range]
 
-        return error_sum
+    # Forget all of the edits
+    def reset(self):
+        self.txn_overrides = {}
+        self.bucketed_overrides = {}
+
+    # The following methods mirror the BasicInfo methods of the same
+    # name, with the edits applied.
+    def get_txn(self, key):
+        if key in self.txn_overrides:
+            return self.txn_overrides[key]
+        return self.info.get_txn(key)
+
+    def is_txn_split(self, transaction):
+        return self.info.is_txn_split(transaction)
+
+    def compiled_check_rules(self):
+        return self.info.compiled_check_rules()
+
+    def split_children_of(self, key):
+        return [self.get_txn(child.key) for child in self.info.split_children_of(key)]
+
+    def is_account_bucketed(self, account, date):
+        if account in self.bucketed_overrides:
+            for date_range in self.bucketed_overrides[account]:
+                if date_range.includes_date(date):
+                    return True
+            return False
+        return self.info.is_account_bucketed(account, date)
+
+    # Returns a list of the DateRange's where the edits change whether
+    # the account is bucketed.
+    def changed_bucketed_dateranges(self, account):
+        ranges = self.bucketed_overrides.get(account, []) + self.info.semi_bucketed_accounts.get(account, [])
+
+        # Whether the account is bucketed can only change at the
+        # boundaries of the date ranges.
+        boundaries = set([datetime.date.min])
+        for date_range in ranges:
+            boundaries.add(date_range.datestart)
+            if date_range.dateend < datetime.date.max:
+                boundaries.add(date_range.dateend + datetime.timedelta(days=1))
+        boundaries = sorted(boundaries)
+
+        changed = []
+        for i in range(len(boundaries)):
+            start = boundaries[i]
+            if self.is_account_bucketed(account, start) != self.info.is_account_bucketed(account, start):
+                if i + 1 < len(boundaries):
+                    changed.append(DateRange(start, boundaries[i+1] - datetime.timedelta(days=1)))
+                else:
+                    changed.append(DateRange(start, datetime.date.max))
+        return changed
+
+    # Returns the keys of all of the transactions whose check results
+    # could be changed by the edits.
+    def affected_txns(self, state):
+        affected = set(self.txn_overrides.keys())
+
+        # Transactions in (or transfers into) an account on the dates
+        # where its bucketed state changed.
+        for account in self.bucketed_overrides.keys():
+            for date_range in self.changed_bucketed_dateranges(account):
+                for index in (state.account_txns, state.sibling_txns):
+                    if account in index:
+                        dates, keys = index[account]
+                        affected.update(keys[bisect.bisect_left(dates, date_range.datestart):
+                                             bisect.bisect_right(dates, date_range.dateend)])
+
+        # Split parents look at their children.
+        for key in list(affected):
+            txn = self.info.get_txn(key)
+            if txn is not None and txn.split_parent:
+                affected.add(txn.split_parent)
+        return [key for key in affected if key in self.info.transactions]
+
+    # Work out what the checks and balances would be with the edits
+    # applied.  Returns a dictionary with:
+    #
+    #   'checks': the error sum of each of the TXN_CHECKS, plus
+    #       check_cash_flow_start, keyed by the check method name
+    #   'error_sum': the sum of those errors
+    #   'bucketed_account_balance', 'bucket_balance', 'difference':
+    #       the current totals compared by check_bucket_balances()
+    #   'bucket_balances': the new balance of each bucket whose balance
+    #       would change
+    def evaluate(self):
+        state = self.info.check_state()
+
+        totals = list(state.totals)
+        for key in self.affected_txns(state):
+            old_errors = state.errors.get(key, [0] * len(TXN_CHECKS))
+            new_errors = txn_check_errors(self, self.get_txn(key))
+            for i in range(len(TXN_CHECKS)):
+                totals[i] += new_errors[i] - old_errors[i]
+
+        # Bucket balances only change when a transaction moves between
+        # buckets.
+        bucket_changes = {}
+        for key, txn in self.txn_overrides.items():
+            old = self.info.get_txn(key)
+            if old.date >= self.cash_flow_start and old.bucket != txn.bucket:
+                cents = amount_to_cents(txn.amount)
+                if old.bucket is not None:
+                    bucket_changes[old.bucket] = bucket_changes.get(old.bucket, 0) - cents
+                if txn.bucket is not None:
+                    bucket_changes[txn.bucket] = bucket_changes.get(txn.bucket, 0) + cents
+
+        # The cash flow start check and the current total of the
+        # bucketed accounts only depend on which accounts are bucketed.
+        cash_flow_start_accounts = [account for account in self.accounts.keys()
+                                    if self.is_account_bucketed(account, self.cash_flow_start)]
+        account_cents = sum([self.info.cash_flow_start_balance_cents(account) for account in cash_flow_start_accounts])
+        starting_cents = sum(map(amount_to_cents, self.info.starting_bucket_balances.values()))
+
+        checks = { 'check_cash_flow_start': cents_to_amount(account_cents - starting_cents) }
+        for i in range(len(TXN_CHECKS)):
+            checks[TXN_CHECKS[i]] = cents_to_amount(totals[i])
+
+        bucketed_cents = sum([state.account_ledger.balance_cents(account) for account in self.accounts.keys()
+                              if self.is_account_bucketed(account, datetime.date.max)])
+        bucket_cents = sum([state.bucket_ledger.balance_cents(bucket) for bucket in self.info.buckets.keys()])
+        bucket_cents += sum([cents for bucket, cents in bucket_changes.items() if bucket in self.info.buckets])
+
+        return { 'checks': checks,
+                 'error_sum': round(sum(checks.values()), 2),
+                 'bucketed_account_balance': cents_to_amount(bucketed_cents),
+                 'bucket_balance': cents_to_amount(bucket_cents),
+                 'difference': cents_to_amount(bucketed_cents - bucket_cents),
+                 'bucket_balances': dict([(bucket, cents_to_amount(state.bucket_ledger.balance_cents(bucket) + cents))
+                                          for bucket, cents in bucket_changes.items() if cents]) }
+
+    # Print out a comparison of the checks and balances with and
+    # without the edits.
+    def print_report(self):
+        before = WhatIf(self.info).evaluate()
+        after = self.evaluate()
+
+        for key, txn in sorted(self.txn_overrides.items()):
+            print '  Assign bucket %s to %s' % (txn.bucket, self.info.get_txn(key))
+        for account, ranges in sorted(self.bucketed_overrides.items()):
+            print '  Account %d (%s) bucketed in date ranges: %s' % (account, self.accounts[account].name, ranges)
+        print ''
+
+        for check in ['check_cash_flow_start'] + TXN_CHECKS:
+            print '  %-50s %12.2f -> %12.2f' % (check, before['checks'][check], after['checks'][check])
+        print '  %-50s %12.2f -> %12.2f' % ('Sum of errors', before['error_sum'], after['error_sum'])
+        print '  %-50s %12.2f -> %12.2f' % ('Bucketed accounts - buckets', before['difference'], after['difference'])
+        for bucket, balance in sorted(after['bucket_balances'].items()):
+            print '  %-50s %12.2f -> %12.2f' % ('Balance of bucket %d (%s)' % (bucket, self.info.buckets[bucket].name),
+                                                self.info.check_state().bucket_ledger.balance(bucket), balance)
+
+# The columns of ZACTIVITY that are read into Transaction objects,
+# in the order transaction_from_row() expects them.
+TRANSACTION_COLUMNS = 'Z_PK,ZDATEYMD,ZACCOUNT2,ZISBUCKETOPTIONAL,ZBUCKET2,ZTRANSFERSIBLING,ZSPLITPARENT,ZPAYEE,ZMEMO,ZAMOUNT'
+
+# The columns of ZBUCKETTRANSFER that are read into MoneyFlow
+# objects, in the order money_flow_from_row() expects them.
+MONEY_FLOW_COLUMNS = 'Z_PK,ZDATEYMD,ZBUCKET,ZTRANSFERSIBLING,ZMEMO,ZAMOUNT'
+
+# Converts a row of TRANSACTION_COLUMNS to a Transaction.  Returns
+# None for rows that should be ignored.
+def transaction_from_row(row):
+    if row[1] == 0 and row[9] == 0:
+        # Some transactions have an invalid date, and if we
+        # try to convert them we get an error.  Ignore them as
+        # long as the amount is also 0.
+        return None
+    key = row[0]
+    date = date_from_ymd(row[1])
+    account = row[2]
+    is_bucket_optional = row[3]
+    bucket = row[4]
+    transfer_sibling = row[5]
+    split_parent = row[6]
+    payee = row[7]
+    memo = row[8]
+    amount = row[9]
+
+    return Transaction(key=key,
+                       date=date,
+                       account=account,
+                       is_bucket_optional=is_bucket_optional,
+                       bucket=bucket,
+                       transfer_sibling=transfer_sibling,
+                       split_parent=split_parent,
+                       payee=payee,
+                       memo=memo,
+                       amount=amount )
+
+# Converts a row of MONEY_FLOW_COLUMNS to a MoneyFlow.
+def money_flow_from_row(row):
+    key = row[0]
+    date = date_from_ymd(row[1])
+    bucket = row[2]
+    transfer_sibling = row[3]
+    memo = row[4]
+    amount = row[5]
+
+    return MoneyFlow(key=key,
+                     date=date,
+                     bucket=bucket,
+                     transfer_sibling=transfer_sibling,
+                     memo=memo,
+                     amount=amount )
 
 # Class to interface to a MoneyWell data file.  Provides methods for
 # reading information from the data file.
@@ -709,12 +1878,14 @@ class DataFile:
             self.is_open = 0
 
         try:
-            self.con = sqlite3.connect(self.name)
+            self.path = self.name
+            self.con = sqlite3.connect(self.path)
         except:
             # Maybe they just specified the path to the MoneyWell data
             # "file" without the path to persistent store inside it?  Let this exception "bubble up" if this attempt fails.
-            self.con = sqlite3.connect(os.path.join(self.name,'StoreContent','persistentStore'))
-        
+            self.path = os.path.join(self.name,'StoreContent','persistentStore')
+            self.con = sqlite3.connect(self.path)
+
         self.cursor = self.con.cursor()
         self.is_open = 1
 
@@ -775,69 +1946,120 @@ class DataFile:
 
         return bucket_balances
 
-    def get_transactions(self):
+    # Returns the transactions in the data file, or those matching an
+    # SQL 'where' clause.
+    def get_transactions(self, where = '', parameters = ()):
         if not self.is_open:
             raise Exception('not open')
 
-        self.cursor.execute('select Z_PK,ZDATEYMD,ZACCOUNT2,ZISBUCKETOPTIONAL,ZBUCKET2,ZTRANSFERSIBLING,ZSPLITPARENT,ZPAYEE,ZMEMO,ZAMOUNT from ZACTIVITY')
+        self.cursor.execute('select %s from ZACTIVITY %s' % (TRANSACTION_COLUMNS, where), parameters)
 
         transactions = {}
         for row in self.cursor:
-            if row[1] == 0 and row[9] == 0:
-                # Some transactions have an invalid date, and if we
-                # try to convert them we get an error.  Ignore them as
-                # long as the amount is also 0.
-                continue
-            key = row[0]
-            date = date_from_ymd(row[1])
-            account = row[2]
-            is_bucket_optional = row[3]
-            bucket = row[4]
-            transfer_sibling = row[5]
-            split_parent = row[6]
-            payee = row[7]
-            memo = row[8]
-            amount = row[9]
-
-            t = Transaction(key=key,
-                            date=date,
-                            account=account,
-                            is_bucket_optional=is_bucket_optional,
-                            bucket=bucket,
-                            transfer_sibling=transfer_sibling,
-                            split_parent=split_parent,
-                            payee=payee,
-                            memo=memo,
-                            amount=amount )
-            transactions[key] = t
+            t = transaction_from_row(row)
+            if t is not None:
+                transactions[t.key] = t
 
         return transactions
 
-    def get_money_flows(self):
+    def get_money_flows(self, where = '', parameters = ()):
         if not self.is_open:
             raise Exception('not open')
 
-        self.cursor.execute('select Z_PK,ZDATEYMD,ZBUCKET,ZTRANSFERSIBLING,ZMEMO,ZAMOUNT from ZBUCKETTRANSFER')
+        self.cursor.execute('select %s from ZBUCKETTRANSFER %s' % (MONEY_FLOW_COLUMNS, where), parameters)
 
         flows = {}
         for row in self.cursor:
-            key = row[0]
-            date = date_from_ymd(row[1])
-            bucket = row[2]
-            transfer_sibling = row[3]
-            memo = row[4]
-            amount = row[5]
-
-            f = MoneyFlow(key=key,
-                          date=date,
-                          bucket=bucket,
-                          transfer_sibling=transfer_sibling,
-                          memo=memo,
-                          amount=amount )
-            flows[key] = f
+            f = money_flow_from_row(row)
+            flows[f.key] = f
 
         return flows
 
+    # Returns the transactions dated after 'date'
+    def get_transactions_after(self, date):
+        return self.get_transactions('where ZDATEYMD > ?', (ymd_from_date(date),))
+
+    # Returns the transactions on or before 'date' that the
+    # transactions after it refer to: the other sides of transfers,
+    # and the parents and children of splits.
+    def get_reference_transactions(self, date):
+        return self.get_transactions('where ZDATEYMD <= ? and (' \
+                                     '  Z_PK in (select ZTRANSFERSIBLING from ZACTIVITY where ZDATEYMD > ?) or' \
+                                     '  Z_PK in (select ZSPLITPARENT from ZACTIVITY where ZDATEYMD > ?) or' \
+                                     '  ZSPLITPARENT in (select Z_PK from ZACTIVITY where ZDATEYMD > ?))',
+                                     (ymd_from_date(date),) * 4)
+
+    def get_money_flows_after(self, date):
+        return self.get_money_flows('where ZDATEYMD > ?', (ymd_from_date(date),))
+
+    # Returns a fingerprint of the rows that the balances and checks up
+    # to and including 'date' depend on, worked out by SQLite: the
+    # transactions and money flows on or before the date, along with
+    # later transactions that are the other side of a transfer or a
+    # split child of one of them.  It is a list of the number of rows
+    # and two sums of hashes of them for each table.
+    def get_sealed_fingerprint(self, date):
+        if not self.is_open:
+            raise Exception('not open')
+
+        ymd = ymd_from_date(date)
+        fingerprint = []
+        for table, columns, where, parameters in (
+                ('ZACTIVITY', FINGERPRINT_TRANSACTION_COLUMNS,
+                 'ZDATEYMD <= ? or' \
+                 '  ZSPLITPARENT in (select Z_PK from ZACTIVITY where ZDATEYMD <= ?) or' \
+                 '  ZTRANSFERSIBLING in (select Z_PK from ZACTIVITY where ZDATEYMD <= ?) or' \
+                 '  Z_PK in (select ZTRANSFERSIBLING from ZACTIVITY where ZDATEYMD <= ?)', (ymd,) * 4),
+                ('ZBUCKETTRANSFER', FINGERPRINT_MONEY_FLOW_COLUMNS, 'ZDATEYMD <= ?', (ymd,))):
+            self.cursor.execute('select count(*), total(h), total(h * h %% %d) from (select %s as h from %s where %s)' %
+                                (FINGERPRINT_MODULUS, row_hash_sql(columns), table, where), parameters)
+            fingerprint.extend([int(value) for value in self.cursor.fetchone()])
+        return fingerprint
+
+    # Returns the rows of a table with the specified primary keys,
+    # reading them a batch of keys at a time.
+    def get_rows_by_key(self, table, columns, keys):
+        if not self.is_open:
+            raise Exception('not open')
+
+        keys = list(keys)
+        rows = []
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i+500]
+            self.cursor.execute('select %s from %s where Z_PK in (%s)' % (columns, table, ','.join('?' * len(batch))), batch)
+            rows.extend(self.cursor.fetchall())
+        return rows
+
+    # Returns a dictionary of the transactions with the specified keys
+    def get_transactions_by_key(self, keys):
+        transactions = {}
+        for row in self.get_rows_by_key('ZACTIVITY', TRANSACTION_COLUMNS, keys):
+            t = transaction_from_row(row)
+            if t is not None:
+                transactions[t.key] = t
+        return transactions
+
+    # Returns a dictionary of the money flows with the specified keys
+    def get_money_flows_by_key(self, keys):
+        flows = {}
+        for row in self.get_rows_by_key('ZBUCKETTRANSFER', MONEY_FLOW_COLUMNS, keys):
+            f = money_flow_from_row(row)
+            flows[f.key] = f
+        return flows
+
+    # Generates a (primary key, fingerprint) tuple for every row in a
+    # table in primary key order, where the fingerprint is a hash of
+    # the listed columns.  The first column must be Z_PK.  This is much
+    # cheaper to hold on to than the rows themselves.
+    def get_row_fingerprints(self, table, columns):
+        if not self.is_open:
+            raise Exception('not open')
+
+        cursor = self.con.cursor()
+        cursor.execute('select %s from %s order by Z_PK' % (columns, table))
+        for row in cursor:
+            yield (row[0], hash(row[1:]))
+
     def get_basic_info(self):
         accounts = self.get_accounts()
         buckets = self.get_buckets()
@@ -854,10 +2076,37 @@ class DataFile:
                          money_flows = flows)
 
 def read_in_basic_info(filename):
+    if is_columnar_export(filename):
+        return read_in_columnar_info(filename)
+
     df = DataFile(filename)
     df.open()
     return df.get_basic_info()
 
+# Returns the file that a document's data is actually in, whose
+# store_stamp() changes when the document does: the persistent store
+# inside a MoneyWell package, the manifest of a columnar export (which
+# is written last), or the file itself.
+def document_store_path(filename):
+    if is_columnar_export(filename):
+        return os.path.join(filename, 'manifest.json')
+
+    df = DataFile(filename)
+    df.open()
+    df.con.close()
+    return df.path
+
+# Returns the key of an account given either its key or its name (as
+# typed on the command line).  Raises an exception if there is no such
+# account.
+def account_from_arg(info, arg):
+    if arg.isdigit() and int(arg) in info.accounts:
+        return int(arg)
+    account = info.account_id_from_name(arg)
+    if account is None:
+        raise Exception('no account %s' % (arg))
+    return account
+
 # Setup for our specific moneywell file:
 def cross_setup(info):
     # Some of our accounts were only bucketed for some of the history range:
@@ -866,6 +2115,1746 @@ def cross_setup(info):
     info.add_account_bucketed_daterange(info.account_id_from_name("The Children's Place CC"),
                                         DateRange(datetime.date(2012,9,29), datetime.date(2013,6,1)) )
 
+# The consistency checks that are run against a document, in order.
+# Each is a description, the name of the BasicInfo method that
+# performs the check, prints its findings (to the file passed as
+# 'out', or to stdout) and returns the sum of the errors it found, and
+# whether that sum should be included in the total of discovered
+# errors (it shouldn't if the errors it finds are also found by the
+# other checks).
+CHECKS = [
+    ('Checking cash flow start', 'check_cash_flow_start', True),
+    ('Checking for bucketed transactions in unbucketed accounts', 'check_for_bucketed_txns_in_unbucketed_accounts', True),
+    ('Checking for unbucketed transactions in bucketed accounts', 'check_for_unbucketed_txns_in_bucketed_accounts', True),
+    ('Checking split transactions for consistency', 'check_splits', True),
+    ('Checking transfers in bucketed accounts', 'check_bucketed_account_transfers', True),
+    ('Checking transfers in unbucketed accounts', 'check_unbucketed_account_transfers', True),
+    ('Checking for duplicate transactions (not included in the sum of errors)', 'check_for_duplicate_txns', False),
+    ('Checking for negative bucket balances (not included in the sum of errors)', 'check_for_negative_intervals', False),
+]
+
+#
+# Query server.  Loads a document once and answers balance, check and
+# transaction queries about it over HTTP with JSON responses, so that
+# other tools don't need to run this script and parse its output.
+#
+
+# Returns something that changes whenever the store at 'path' is
+# written to: the modification time and size of the store and of its
+# write-ahead log, if it has one.
+def store_stamp(path):
+    stamp = []
+    for name in (path, path + '-wal'):
+        if os.path.exists(name):
+            st = os.stat(name)
+            stamp.append((st.st_mtime, st.st_size))
+        else:
+            stamp.append(None)
+    return tuple(stamp)
+
+# Returns a dictionary describing a transaction, suitable for JSON.
+def txn_to_dict(txn):
+    return { 'key': txn.key,
+             'date': txn.date.isoformat(),
+             'account': txn.account,
+             'bucket': txn.bucket,
+             'is_bucket_optional': bool(txn.is_bucket_optional),
+             'transfer_sibling': txn.transfer_sibling,
+             'split_parent': txn.split_parent,
+             'payee': txn.payee,
+             'memo': txn.memo,
+             'amount': txn.amount }
+
+# A document that has been loaded into memory along with the indexes
+# the query server uses to answer queries, and the results of running
+# all of the CHECKS against it.  'setup' is an optional function that
+# is called with the BasicInfo before anything is computed from it
+# (for example cross_setup).
+class ResidentInfo:
+    def __init__(self, filename, setup = None):
+        self.path = document_store_path(filename)
+        self.stamp = store_stamp(self.path)
+        self.info = read_in_basic_info(filename)
+        if setup:
+            setup(self.info)
+
+        self.loaded = datetime.datetime.now()
+        self.account_ledger, self.bucket_ledger = self.info.build_balance_ledgers()
+
+        # Transactions sorted by date, all together and for each
+        # account and bucket, so that date range queries are a binary
+        # search.
+        self.txns = sorted(self.info.transactions.values(), key = lambda txn: (txn.date, txn.key))
+        self.txn_dates = [txn.date for txn in self.txns]
+        self.account_txns = {}
+        self.bucket_txns = {}
+        for txn in self.txns:
+            self.account_txns.setdefault(txn.account, []).append(txn)
+            if txn.bucket is not None:
+                self.bucket_txns.setdefault(txn.bucket, []).append(txn)
+        self.account_txn_dates = dict([(key, [txn.date for txn in txns]) for key, txns in self.account_txns.items()])
+        self.bucket_txn_dates = dict([(key, [txn.date for txn in txns]) for key, txns in self.bucket_txns.items()])
+
+        # Keep the findings each check prints along with its result.
+        self.checks = []
+        for description, check, in_total in CHECKS:
+            report = StringIO.StringIO()
+            error_sum = getattr(self.info, check)(out = report)
+            self.checks.append({ 'check': check,
+                                 'description': description,
+                                 'error_sum': round(error_sum, 2),
+                                 'in_total': in_total,
+                                 'report': report.getvalue() })
+
+    # Returns the transactions in the account or bucket (or all
+    # transactions if neither is specified) between the dates, sorted
+    # by date.
+    def transactions(self, account = None, bucket = None, datestart = datetime.date.min, dateend = datetime.date.max):
+        if account is not None:
+            txns = self.account_txns.get(account, [])
+            dates = self.account_txn_dates.get(account, [])
+        elif bucket is not None:
+            txns = self.bucket_txns.get(bucket, [])
+            dates = self.bucket_txn_dates.get(bucket, [])
+        else:
+            txns = self.txns
+            dates = self.txn_dates
+
+        txns = txns[bisect.bisect_left(dates, datestart):bisect.bisect_right(dates, dateend)]
+        if account is not None and bucket is not None:
+            txns = [txn for txn in txns if txn.bucket == bucket]
+        return txns
+
+# Raised by the query handler to send an error response to the client
+class QueryError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+# Handles one HTTP request to the query server.  Every response is a
+# JSON document.
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict([(name, values[-1]) for name, values in urlparse.parse_qs(url.query).items()])
+
+        handler = getattr(self, 'query_' + url.path.strip('/').replace('/', '_'), None)
+        try:
+            if handler is None:
+                raise QueryError(404, 'unknown query %s' % (url.path))
+            self.send_json(200, handler(self.server.resident(), params))
+        except QueryError, e:
+            self.send_json(e.status, { 'error': str(e) })
+        except Exception, e:
+            self.log_error('%s failed: %s', self.path, e)
+            self.send_json(500, { 'error': str(e) })
+
+    def send_json(self, status, result):
+        body = json.dumps(result)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    # Helpers to pull typed parameters out of the query string.
+    def int_param(self, params, name):
+        if name not in params:
+            return None
+        try:
+            return int(params[name])
+        except ValueError:
+            raise QueryError(400, '%s must be an integer' % (name))
+
+    def date_param(self, params, name, default):
+        if name not in params:
+            return default
+        try:
+            return datetime.datetime.strptime(params[name], '%Y-%m-%d').date()
+        except ValueError:
+            raise QueryError(400, '%s must be a date in YYYY-MM-DD format' % (name))
+
+    # /status
+    def query_status(self, resident, params):
+        return { 'path': resident.path,
+                 'loaded': resident.loaded.isoformat(),
+                 'cash_flow_start': resident.info.cash_flow_start.isoformat(),
+                 'transactions': len(resident.info.transactions),
+                 'money_flows': len(resident.info.money_flows),
+                 'reload_error': self.server.reload_error }
+
+    # /accounts[?date=YYYY-MM-DD]
+    def query_accounts(self, resident, params):
+        date = self.date_param(params, 'date', datetime.date.max)
+        return [{ 'key': account.key,
+                  'name': account.name,
+                  'bucketed': bool(resident.info.is_account_bucketed(account.key, date)),
+                  'balance': resident.account_ledger.balance(account.key, date) }
+                for account in resident.info.accounts.values()]
+
+    # /buckets[?date=YYYY-MM-DD]
+    def query_buckets(self, resident, params):
+        date = self.date_param(params, 'date', datetime.date.max)
+        return [{ 'key': bucket.key,
+                  'name': bucket.name,
+                  'hidden': bool(bucket.hidden),
+                  'balance': resident.bucket_ledger.balance(bucket.key, date) }
+                for bucket in resident.info.buckets.values()]
+
+    # /balance?account=N[&date=YYYY-MM-DD] or /balance?bucket=N[&date=YYYY-MM-DD]
+    def query_balance(self, resident, params):
+        date = self.date_param(params, 'date', datetime.date.max)
+        account = self.int_param(params, 'account')
+        bucket = self.int_param(params, 'bucket')
+        if account is not None:
+            if account not in resident.info.accounts:
+                raise QueryError(404, 'no account %d' % (account))
+            return { 'account': account, 'balance': resident.account_ledger.balance(account, date) }
+        if bucket is not None:
+            if bucket not in resident.info.buckets:
+                raise QueryError(404, 'no bucket %d' % (bucket))
+            return { 'bucket': bucket, 'balance': resident.bucket_ledger.balance(bucket, date) }
+        raise QueryError(400, 'either account or bucket must be specified')
+
+    # /totals[?date=YYYY-MM-DD]: bucketed account total vs. bucket total
+    def query_totals(self, resident, params):
+        date = self.date_param(params, 'date', datetime.date.max)
+        account_sum = sum([resident.account_ledger.balance_cents(account, date)
+                           for account in resident.info.bucketed_accounts(date)])
+        bucket_sum = sum([resident.bucket_ledger.balance_cents(bucket, date)
+                          for bucket in resident.info.buckets.keys()])
+        return { 'bucketed_accounts': cents_to_amount(account_sum),
+                 'buckets': cents_to_amount(bucket_sum),
+                 'difference': cents_to_amount(account_sum - bucket_sum) }
+
+    # /transaction?key=N
+    def query_transaction(self, resident, params):
+        key = self.int_param(params, 'key')
+        if key is None:
+            raise QueryError(400, 'key must be specified')
+        if key not in resident.info.transactions:
+            raise QueryError(404, 'no transaction %s' % (key))
+        return txn_to_dict(resident.info.transactions[key])
+
+    # /transactions[?account=N][&bucket=N][&start=YYYY-MM-DD][&end=YYYY-MM-DD]
+    def query_transactions(self, resident, params):
+        txns = resident.transactions(account = self.int_param(params, 'account'),
+                                     bucket = self.int_param(params, 'bucket'),
+                                     datestart = self.date_param(params, 'start', datetime.date.min),
+                                     dateend = self.date_param(params, 'end', datetime.date.max))
+        return map(txn_to_dict, txns)
+
+    # /checks
+    def query_checks(self, resident, params):
+        return { 'checks': resident.checks,
+                 'error_sum': round(sum([check['error_sum'] for check in resident.checks if check['in_total']]), 2) }
+
+# A threaded HTTP server that answers queries about a ResidentInfo,
+# reloading it in a background thread when the underlying store
+# changes.  Requests keep being answered from the old copy while a new
+# copy is being loaded, and if the load fails (for example because
+# the store is half written) the old copy stays in use until the
+# store changes again.
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    # How often (in seconds) to look at the store to see if it changed
+    reload_check_interval = 1.0
+
+    def __init__(self, address, filename, setup = None, verbose = False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, QueryHandler)
+        self.filename = filename
+        self.setup = setup
+        self.verbose = verbose
+        self.current = ResidentInfo(filename, setup)
+        self.last_check = time.time()
+        self.reload_lock = threading.Lock()
+        self.reloading = False
+
+        # The stamp of the store the last time a reload failed, and
+        # why it failed.
+        self.failed_stamp = None
+        self.reload_error = None
+
+    # Returns the current ResidentInfo, starting a reload in the
+    # background if the store has changed since it was loaded.
+    def resident(self):
+        current = self.current
+        now = time.time()
+        if now - self.last_check < self.reload_check_interval:
+            return current
+
+        # Only one reload runs at a time; the other threads keep using
+        # the old copy.
+        if not self.reload_lock.acquire(False):
+            return current
+        try:
+            if not self.reloading:
+                self.last_check = now
+                stamp = store_stamp(current.path)
+                if stamp != current.stamp and stamp != self.failed_stamp:
+                    if self.verbose:
+                        print 'Reloading %s' % (current.path)
+                    self.reloading = True
+                    thread = threading.Thread(target = self.reload, args = (stamp,))
+                    thread.daemon = True
+                    thread.start()
+        finally:
+            self.reload_lock.release()
+        return current
+
+    # Loads a new copy of the document, which is then used by the
+    # requests that follow.  'stamp' is the stamp of the store that
+    # prompted the reload.
+    def reload(self, stamp):
+        try:
+            resident = ResidentInfo(self.filename, self.setup)
+        except Exception, e:
+            self.failed_stamp = stamp
+            self.reload_error = str(e)
+            print >>sys.stderr, 'Could not reload %s (%s), still using the copy loaded at %s' % \
+                (self.current.path, e, self.current.loaded.isoformat())
+        else:
+            self.current = resident
+            self.failed_stamp = None
+            self.reload_error = None
+        self.reloading = False
+
+def serve_queries(filename, address, port, setup = None, verbose = False):
+    server = QueryServer((address, port), filename, setup, verbose)
+    print 'Serving queries about %s on http://%s:%d/' % (server.current.path, address, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+#
+# Snapshot diffs.  Compares two versions of a document (for example a
+# backup and the current file) to find out what changed and how those
+# changes affected account and bucket balances.
+#
+
+# Merge joins two sequences of (primary key, fingerprint) tuples, each
+# sorted by primary key, so that neither side has to be held in memory.
+# Returns a tuple of sorted lists of the (added, removed, modified) keys.
+def diff_fingerprints(old_rows, new_rows):
+    added = []
+    removed = []
+    modified = []
+    old_rows = iter(old_rows)
+    new_rows = iter(new_rows)
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            removed.append(old[0])
+            old = next(old_rows, None)
+        elif old is None or new[0] < old[0]:
+            added.append(new[0])
+            new = next(new_rows, None)
+        else:
+            if old[1] != new[1]:
+                modified.append(new[0])
+            old = next(old_rows, None)
+            new = next(new_rows, None)
+    return (added, removed, modified)
+
+# The differences between two versions of a document.  'old' and 'new'
+# must be open DataFiles.  Only the rows that changed are ever turned
+# into Transaction and MoneyFlow objects.  'setup' is an optional
+# function that is applied to a BasicInfo with the new version's
+# accounts, so that the accounts it makes sometimes bucketed are
+# counted as the checks count them.
+class DocumentDiff:
+    def __init__(self, old, new, setup = None):
+        self.old_cash_flow_start = old.get_cash_flow_start_date()
+        self.new_cash_flow_start = new.get_cash_flow_start_date()
+        self.accounts = new.get_accounts()
+        self.old_accounts = old.get_accounts()
+        self.buckets = new.get_buckets()
+        self.old_buckets = old.get_buckets()
+        self.old_starting_bucket_balances = old.get_starting_bucket_balances(None)
+        self.new_starting_bucket_balances = new.get_starting_bucket_balances(None)
+
+        self.probe = BasicInfo(self.accounts, self.buckets, self.new_cash_flow_start, self.new_starting_bucket_balances, {}, {})
+        if setup:
+            setup(self.probe)
+
+        self.txn_changes = diff_fingerprints(old.get_row_fingerprints('ZACTIVITY', TRANSACTION_COLUMNS),
+                                             new.get_row_fingerprints('ZACTIVITY', TRANSACTION_COLUMNS))
+        self.flow_changes = diff_fingerprints(old.get_row_fingerprints('ZBUCKETTRANSFER', MONEY_FLOW_COLUMNS),
+                                              new.get_row_fingerprints('ZBUCKETTRANSFER', MONEY_FLOW_COLUMNS))
+
+        # Now read in just the rows that changed from each side.
+        added, removed, modified = self.txn_changes
+        self.old_txns = old.get_transactions_by_key(removed + modified)
+        self.new_txns = new.get_transactions_by_key(added + modified)
+        added, removed, modified = self.flow_changes
+        self.old_flows = old.get_money_flows_by_key(removed + modified)
+        self.new_flows = new.get_money_flows_by_key(added + modified)
+
+        # Work out the effect of the changes on each account and bucket
+        # balance (in cents) by removing the contribution of the old
+        # version of each row and adding the contribution of the new.
+        self.account_effects = {}
+        self.bucket_effects = {}
+
+        def add_effect(effects, key, cents):
+            effects[key] = effects.get(key, 0) + cents
+
+        for txns, cash_flow_start, sign in ((self.old_txns, self.old_cash_flow_start, -1),
+                                            (self.new_txns, self.new_cash_flow_start, 1)):
+            for txn in txns.values():
+                cents = sign * amount_to_cents(txn.amount)
+                if txn.split_parent is None:
+                    add_effect(self.account_effects, txn.account, cents)
+                if txn.bucket is not None and txn.date >= cash_flow_start:
+                    add_effect(self.bucket_effects, txn.bucket, cents)
+
+        for flows, cash_flow_start, sign in ((self.old_flows, self.old_cash_flow_start, -1),
+                                             (self.new_flows, self.new_cash_flow_start, 1)):
+            for flow in flows.values():
+                if flow.date >= cash_flow_start:
+                    add_effect(self.bucket_effects, flow.bucket, sign * amount_to_cents(flow.amount))
+
+        for bucket in set(self.old_starting_bucket_balances.keys()) | set(self.new_starting_bucket_balances.keys()):
+            cents = amount_to_cents(self.new_starting_bucket_balances.get(bucket, 0)) - \
+                amount_to_cents(self.old_starting_bucket_balances.get(bucket, 0))
+            if cents:
+                add_effect(self.bucket_effects, bucket, cents)
+
+        for effects in (self.account_effects, self.bucket_effects):
+            for key in [key for key in effects.keys() if not effects[key]]:
+                del effects[key]
+
+    # Returns true if nothing changed
+    def is_empty(self):
+        return not (self.account_effects or self.bucket_effects or
+                    sum(map(len, self.txn_changes + self.flow_changes)) or
+                    set(self.accounts.keys()) != set(self.old_accounts.keys()) or
+                    set(self.buckets.keys()) != set(self.old_buckets.keys()) or
+                    self.old_cash_flow_start != self.new_cash_flow_start)
+
+    # Names come from the new version, or the old one for accounts and
+    # buckets that have since been removed.
+    def account_name(self, account):
+        if account in self.accounts:
+            return self.accounts[account].name
+        if account in self.old_accounts:
+            return self.old_accounts[account].name
+        return '?'
+
+    def bucket_name(self, bucket):
+        if bucket in self.buckets:
+            return self.buckets[bucket].name
+        if bucket in self.old_buckets:
+            return self.old_buckets[bucket].name
+        return '?'
+
+    # Print out a report of the differences.
+    def print_report(self):
+        if self.is_empty():
+            print 'No differences found.'
+            return
+
+        if self.old_cash_flow_start != self.new_cash_flow_start:
+            print '  *** Cash flow start date changed from %s to %s (balance effects below only cover changed rows)' % \
+                (self.old_cash_flow_start.isoformat(), self.new_cash_flow_start.isoformat())
+
+        for title, old, new in (('Account', self.old_accounts, self.accounts),
+                                ('Bucket', self.old_buckets, self.buckets)):
+            for key in sorted(set(new.keys()) - set(old.keys())):
+                print '  *** %s %d (%s) added' % (title, key, new[key].name)
+            for key in sorted(set(old.keys()) - set(new.keys())):
+                print '  *** %s %d (%s) removed' % (title, key, old[key].name)
+
+        for account in sorted(self.accounts.keys()):
+            if account in self.old_accounts and bool(self.old_accounts[account].bucketed) != bool(self.accounts[account].bucketed):
+                print '  *** Account %d (%s) changed from %s to %s' % \
+                    (account, self.account_name(account),
+                     ['unbucketed', 'bucketed'][bool(self.old_accounts[account].bucketed)],
+                     ['unbucketed', 'bucketed'][bool(self.accounts[account].bucketed)])
+
+        for title, changes, old_rows, new_rows in (('Transactions', self.txn_changes, self.old_txns, self.new_txns),
+                                                   ('Money flows', self.flow_changes, self.old_flows, self.new_flows)):
+            added, removed, modified = changes
+            print '%s: %d added, %d removed, %d modified' % (title, len(added), len(removed), len(modified))
+            for key in added:
+                if key in new_rows:
+                    print '  + %s' % (new_rows[key])
+            for key in removed:
+                if key in old_rows:
+                    print '  - %s' % (old_rows[key])
+            for key in modified:
+                print '  ~ %s' % (old_rows.get(key, '[%d] (had no date or amount, so was ignored)' % (key)))
+                print '    %s' % (new_rows.get(key, '[%d] (has no date or amount, so is ignored)' % (key)))
+
+        print ''
+        if self.account_effects:
+            print 'Effect on account balances:'
+            for account in sorted(self.account_effects.keys()):
+                print '  %4s: %-30s %+12.2f' % (account, self.account_name(account), cents_to_amount(self.account_effects[account]))
+        else:
+            print 'No effect on account balances.'
+
+        print ''
+        if self.bucket_effects:
+            print 'Effect on bucket balances:'
+            for bucket in sorted(self.bucket_effects.keys()):
+                print '  %4s: %-30s %+12.2f' % (bucket, self.bucket_name(bucket), cents_to_amount(self.bucket_effects[bucket]))
+        else:
+            print 'No effect on bucket balances.'
+
+        # The net effect on the difference between the bucketed
+        # accounts and the buckets, using the same sign as the checks
+        # and the same accounts as check_bucket_balances().
+        account_cents = sum([cents for account, cents in self.account_effects.items()
+                             if account in self.accounts and self.probe.is_account_bucketed(account, datetime.date.max)])
+        bucket_cents = sum(self.bucket_effects.values())
+        print ''
+        print '  *** Net effect on bucketed accounts - buckets: %.2f' % (cents_to_amount(account_cents - bucket_cents))
+
+        # Whether a bucket is optional only matters to the checks, so
+        # it isn't part of the effects above.
+        optional_changes = [key for key in self.txn_changes[2] if key in self.old_txns and key in self.new_txns and
+                            bool(self.old_txns[key].is_bucket_optional) != bool(self.new_txns[key].is_bucket_optional)]
+        if optional_changes:
+            print '  *** %d transaction(s) changed whether their bucket is optional, which affects the checks but not the balances' % \
+                (len(optional_changes))
+
+def diff_documents(old_filename, new_filename, setup = None):
+    old = DataFile(old_filename)
+    old.open()
+    new = DataFile(new_filename)
+    new.open()
+
+    print 'Comparing %s to %s:' % (old.path, new.path)
+    print ''
+    DocumentDiff(old, new, setup).print_report()
+
+#
+# Columnar export.  Writes what DataFile read from a document to a
+# directory of .npy files (one per column) along with a manifest.json
+# describing them, so that other tools (numpy.load() with mmap_mode
+# for example) can open the data without going through the Core Data
+# schema, and so that this script can read it back in quickly.
+#
+# Integer columns that can be NULL hold 0 for NULL (the Z_PK's in a
+# data file start at 1).  Dates are YYYYMMDD integers.  A string column
+# is stored as three files: the UTF-8 bytes of all of the strings
+# one after another, the offsets where each string starts (with one
+# extra offset at the end), and a mask of the strings that are NULL.
+#
+
+COLUMNAR_FORMAT = 'mw_analyze columnar'
+COLUMNAR_VERSION = 1
+
+# Returns the .npy description of the type of the items in an array
+def npy_descr(data):
+    if data.typecode == 'd':
+        return '<f8'
+    if data.typecode == 'B':
+        return '|u1'
+    return '<i%d' % (data.itemsize)
+
+# Returns the array typecode for a .npy description
+def typecode_from_npy_descr(descr):
+    for typecode in 'Bild':
+        if npy_descr(array.array(typecode)) == descr:
+            return typecode
+    raise Exception('unsupported .npy type %s' % (descr))
+
+# Writes the values to a .npy file as a one dimensional array of the
+# array module 'typecode'.
+def write_npy(filename, typecode, values):
+    if isinstance(values, array.array) and values.typecode == typecode:
+        data = values
+    else:
+        data = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        data.byteswap()
+
+    # The header is padded so that the data starts on a 64 byte boundary.
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (npy_descr(data), len(data))
+    header += ' ' * ((64 - (10 + len(header) + 1) % 64) % 64) + '\n'
+
+    f = open(filename, 'wb')
+    f.write('\x93NUMPY\x01\x00')
+    f.write(struct.pack('<H', len(header)))
+    f.write(header)
+    data.tofile(f)
+    f.close()
+
+# Reads the header of a one dimensional .npy file written by
+# write_npy() (or numpy) from the open file 'f', leaving it at the
+# start of the data.  Returns a tuple of the array typecode and the
+# number of items.
+def read_npy_header(f, filename):
+    magic = f.read(8)
+    if magic[:6] != '\x93NUMPY':
+        raise Exception('%s is not a .npy file' % (filename))
+    if ord(magic[6]) == 1:
+        header_length = struct.unpack('<H', f.read(2))[0]
+    else:
+        header_length = struct.unpack('<I', f.read(4))[0]
+
+    header = ast.literal_eval(f.read(header_length))
+    if header['fortran_order'] or len(header['shape']) != 1:
+        raise Exception('%s is not a one dimensional array' % (filename))
+    return (typecode_from_npy_descr(header['descr']), header['shape'][0])
+
+# Reads a one dimensional .npy file into an array.  This is a plain
+# read: the data is read straight from the file into the array, so it
+# is only held in memory once, but all of it is read.
+def read_npy(filename):
+    f = open(filename, 'rb')
+    try:
+        typecode, count = read_npy_header(f, filename)
+        data = array.array(typecode)
+        data.fromfile(f, count)
+    finally:
+        f.close()
+
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data
+
+# Reads a .npy file of bytes (as written by write_string_column())
+# into a string.
+def read_npy_bytes(filename):
+    f = open(filename, 'rb')
+    try:
+        typecode, count = read_npy_header(f, filename)
+        if typecode != 'B':
+            raise Exception('%s is not an array of bytes' % (filename))
+        data = f.read(count)
+    finally:
+        f.close()
+
+    if len(data) != count:
+        raise Exception('%s is truncated' % (filename))
+    return data
+
+# Writes the integer column 'values', which may contain None, to
+# directory/name.npy and returns its manifest entry.
+def write_int_column(directory, name, values, typecode = 'l'):
+    write_npy(os.path.join(directory, name + '.npy'), typecode, [value or 0 for value in values])
+    return { 'file': name + '.npy' }
+
+# Writes a column of floats to directory/name.npy and returns its
+# manifest entry.
+def write_float_column(directory, name, values):
+    write_npy(os.path.join(directory, name + '.npy'), 'd', values)
+    return { 'file': name + '.npy' }
+
+# Writes a column of strings, which may contain None, and returns its
+# manifest entry.
+def write_string_column(directory, name, values):
+    data = []
+    offsets = [0]
+    for value in values:
+        if value:
+            data.append(value.encode('utf-8'))
+            offsets.append(offsets[-1] + len(data[-1]))
+        else:
+            offsets.append(offsets[-1])
+    data = ''.join(data)
+
+    write_npy(os.path.join(directory, name + '.utf8.npy'), 'B', array.array('B', data))
+    write_npy(os.path.join(directory, name + '.offsets.npy'), 'l', offsets)
+    write_npy(os.path.join(directory, name + '.nulls.npy'), 'B', [value is None for value in values])
+    return { 'data': name + '.utf8.npy', 'offsets': name + '.offsets.npy', 'nulls': name + '.nulls.npy' }
+
+# Reads an integer column, turning 0 back into None if 'nullable'.
+def read_int_column(directory, entry, nullable = False):
+    data = read_npy(os.path.join(directory, entry['file']))
+    if nullable:
+        return [value or None for value in data]
+    return data
+
+def read_float_column(directory, entry):
+    return read_npy(os.path.join(directory, entry['file']))
+
+def read_string_column(directory, entry):
+    data = read_npy_bytes(os.path.join(directory, entry['data']))
+    offsets = read_npy(os.path.join(directory, entry['offsets']))
+    nulls = read_npy(os.path.join(directory, entry['nulls']))
+    return [None if nulls[i] else data[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(nulls))]
+
+# Returns the YYYYMMDD integer for a datetime.date
+def ymd_from_date(date):
+    return date.year * 10000 + date.month * 100 + date.day
+
+# Exports the accounts, buckets, settings, transactions and money flows
+# in a BasicInfo to a directory of .npy files with a manifest.json.
+def export_columnar(info, directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    manifest = { 'format': COLUMNAR_FORMAT,
+                 'version': COLUMNAR_VERSION,
+                 'cash_flow_start': ymd_from_date(info.cash_flow_start),
+                 'tables': {} }
+    tables = manifest['tables']
+
+    accounts = sorted(info.accounts.values(), key = lambda account: account.key)
+    tables['accounts'] = { 'rows': len(accounts), 'columns': {
+        'key': write_int_column(directory, 'accounts.key', [account.key for account in accounts]),
+        'name': write_string_column(directory, 'accounts.name', [account.name for account in accounts]),
+        'bucketed': write_int_column(directory, 'accounts.bucketed', [bool(account.bucketed) for account in accounts], 'B') } }
+
+    buckets = sorted(info.buckets.values(), key = lambda bucket: bucket.key)
+    tables['buckets'] = { 'rows': len(buckets), 'columns': {
+        'key': write_int_column(directory, 'buckets.key', [bucket.key for bucket in buckets]),
+        'name': write_string_column(directory, 'buckets.name', [bucket.name for bucket in buckets]),
+        'hidden': write_int_column(directory, 'buckets.hidden', [bool(bucket.hidden) for bucket in buckets], 'B') } }
+
+    balances = sorted(info.starting_bucket_balances.items())
+    tables['starting_bucket_balances'] = { 'rows': len(balances), 'columns': {
+        'bucket': write_int_column(directory, 'starting_bucket_balances.bucket', [bucket for bucket, amount in balances]),
+        'amount': write_float_column(directory, 'starting_bucket_balances.amount', [amount for bucket, amount in balances]) } }
+
+    txns = sorted(info.transactions.values(), key = lambda txn: txn.key)
+    tables['transactions'] = { 'rows': len(txns), 'columns': {
+        'key': write_int_column(directory, 'transactions.key', [txn.key for txn in txns]),
+        'date': write_int_column(directory, 'transactions.date', [ymd_from_date(txn.date) for txn in txns], 'i'),
+        'account': write_int_column(directory, 'transactions.account', [txn.account for txn in txns]),
+        'is_bucket_optional': write_int_column(directory, 'transactions.is_bucket_optional',
+                                               [bool(txn.is_bucket_optional) for txn in txns], 'B'),
+        'bucket': write_int_column(directory, 'transactions.bucket', [txn.bucket for txn in txns]),
+        'transfer_sibling': write_int_column(directory, 'transactions.transfer_sibling', [txn.transfer_sibling for txn in txns]),
+        'split_parent': write_int_column(directory, 'transactions.split_parent', [txn.split_parent for txn in txns]),
+        'payee': write_string_column(directory, 'transactions.payee', [txn.payee for txn in txns]),
+        'memo': write_string_column(directory, 'transactions.memo', [txn.memo for txn in txns]),
+        'amount': write_float_column(directory, 'transactions.amount', [txn.amount for txn in txns]) } }
+
+    flows = sorted(info.money_flows.values(), key = lambda flow: flow.key)
+    tables['money_flows'] = { 'rows': len(flows), 'columns': {
+        'key': write_int_column(directory, 'money_flows.key', [flow.key for flow in flows]),
+        'date': write_int_column(directory, 'money_flows.date', [ymd_from_date(flow.date) for flow in flows], 'i'),
+        'bucket': write_int_column(directory, 'money_flows.bucket', [flow.bucket for flow in flows]),
+        'transfer_sibling': write_int_column(directory, 'money_flows.transfer_sibling', [flow.transfer_sibling for flow in flows]),
+        'memo': write_string_column(directory, 'money_flows.memo', [flow.memo for flow in flows]),
+        'amount': write_float_column(directory, 'money_flows.amount', [flow.amount for flow in flows]) } }
+
+    # The manifest is written last, so a directory with a manifest in
+    # it always has all of its columns.
+    f = open(os.path.join(directory, 'manifest.json'), 'w')
+    json.dump(manifest, f, indent = 2, sort_keys = True)
+    f.close()
+
+# Returns true if 'directory' holds a document exported by export_columnar()
+def is_columnar_export(directory):
+    return os.path.isfile(os.path.join(directory, 'manifest.json'))
+
+# Reads a document exported by export_columnar() back into a BasicInfo
+def read_in_columnar_info(directory):
+    f = open(os.path.join(directory, 'manifest.json'))
+    manifest = json.load(f)
+    f.close()
+    if manifest.get('format') != COLUMNAR_FORMAT or manifest.get('version') != COLUMNAR_VERSION:
+        raise Exception('%s is not a supported columnar export' % (directory))
+    tables = manifest['tables']
+
+    columns = tables['accounts']['columns']
+    accounts = {}
+    for key, name, bucketed in zip(read_int_column(directory, columns['key']),
+                                   read_string_column(directory, columns['name']),
+                                   read_int_column(directory, columns['bucketed'])):
+        accounts[key] = Account(key=key, name=name, bucketed=bucketed)
+
+    columns = tables['buckets']['columns']
+    buckets = {}
+    for key, name, hidden in zip(read_int_column(directory, columns['key']),
+                                 read_string_column(directory, columns['name']),
+                                 read_int_column(directory, columns['hidden'])):
+        buckets[key] = Bucket(key=key, name=name, hidden=hidden)
+
+    columns = tables['starting_bucket_balances']['columns']
+    starting_bucket_balances = dict(zip(read_int_column(directory, columns['bucket']),
+                                        read_float_column(directory, columns['amount'])))
+
+    columns = tables['transactions']['columns']
+    transactions = {}
+    for row in zip(read_int_column(directory, columns['key']),
+                   map(date_from_ymd, read_int_column(directory, columns['date'])),
+                   read_int_column(directory, columns['account'], True),
+                   read_int_column(directory, columns['is_bucket_optional']),
+                   read_int_column(directory, columns['bucket'], True),
+                   read_int_column(directory, columns['transfer_sibling'], True),
+                   read_int_column(directory, columns['split_parent'], True),
+                   read_string_column(directory, columns['payee']),
+                   read_string_column(directory, columns['memo']),
+                   read_float_column(directory, columns['amount'])):
+        transactions[row[0]] = Transaction(*row)
+
+    columns = tables['money_flows']['columns']
+    flows = {}
+    for row in zip(read_int_column(directory, columns['key']),
+                   map(date_from_ymd, read_int_column(directory, columns['date'])),
+                   read_int_column(directory, columns['bucket'], True),
+                   read_int_column(directory, columns['transfer_sibling'], True),
+                   read_string_column(directory, columns['memo']),
+                   read_float_column(directory, columns['amount'])):
+        flows[row[0]] = MoneyFlow(*row)
+
+    return BasicInfo(accounts = accounts,
+                     buckets = buckets,
+                     cash_flow_start = date_from_ymd(manifest['cash_flow_start']),
+                     starting_bucket_balances = starting_bucket_balances,
+                     transactions = transactions,
+                     money_flows = flows)
+
+#
+# Statement reconciliation.  Matches the lines of a bank's statement
+# (a CSV or OFX download) against the transactions in an account, to
+# find transactions that are missing from, or doubled in, MoneyWell.
+#
+
+# A line of a bank statement.  'line' identifies where it came from
+# in the statement (a line number or the OFX FITID).
+class StatementLine:
+    def __init__(self, line, date, amount, payee, memo):
+        self.line = line
+        self.date = date
+        self.amount = amount
+        self.payee = payee
+        self.memo = memo
+
+    def __repr__(self):
+        return '[%s] %s: %.2f %s (%s)' % (self.line, self.date.isoformat(), self.amount, self.payee, self.memo)
+
+# Converts an amount as written in a statement ("$1,234.56",
+# "(12.00)", "-12.00") to a float.  A blank amount is 0.
+def amount_from_statement(text):
+    text = text.strip().replace('$', '').replace(',', '')
+    if text in ('', '-'):
+        return 0.0
+    if text.startswith('(') and text.endswith(')'):
+        return -float(text[1:-1])
+    return float(text)
+
+# The date formats tried (in order) for dates in CSV statements
+STATEMENT_DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%Y/%m/%d', '%d-%b-%Y', '%b %d, %Y']
+
+def date_from_statement(text, date_format = None):
+    text = text.strip()
+    for f in ([date_format] if date_format else STATEMENT_DATE_FORMATS):
+        try:
+            return datetime.datetime.strptime(text, f).date()
+        except ValueError:
+            pass
+    raise Exception('unrecognized statement date %s' % (text))
+
+# Reads the lines of a CSV statement.  The first row must name the
+# columns: a date column, either an amount column or debit and credit
+# columns, and optionally payee and memo columns, under any of the
+# names banks commonly use for them.  Blank amounts (including the
+# empty one of a debit and credit pair) are taken as 0.
+def read_csv_statement(filename, date_format = None):
+    names = { 'date': ['date', 'posted date', 'posting date', 'transaction date', 'trans date'],
+              'amount': ['amount', 'transaction amount'],
+              'debit': ['debit', 'withdrawal', 'withdrawals'],
+              'credit': ['credit', 'deposit', 'deposits'],
+              'payee': ['payee', 'description', 'name', 'merchant', 'original description'],
+              'memo': ['memo', 'notes', 'details'] }
+
+    f = open(filename, 'rU')
+    reader = csv.reader(f)
+    header = [name.strip().lower() for name in reader.next()]
+    columns = {}
+    for column, candidates in names.items():
+        for candidate in candidates:
+            if candidate in header:
+                columns[column] = header.index(candidate)
+                break
+    if 'date' not in columns or not ('amount' in columns or 'debit' in columns or 'credit' in columns):
+        raise Exception('%s does not have date and amount columns' % (filename))
+
+    def field(row, column):
+        if column in columns and columns[column] < len(row):
+            return row[columns[column]].strip()
+        return ''
+
+    lines = []
+    dates = {}  # statements repeat the same dates many times, and strptime() is slow
+    for row in reader:
+        if not field(row, 'date'):
+            continue
+        if field(row, 'date') not in dates:
+            dates[field(row, 'date')] = date_from_statement(field(row, 'date'), date_format)
+        if field(row, 'amount'):
+            amount = amount_from_statement(field(row, 'amount'))
+        else:
+            amount = 0.0
+            if field(row, 'credit'):
+                amount += abs(amount_from_statement(field(row, 'credit')))
+            if field(row, 'debit'):
+                amount -= abs(amount_from_statement(field(row, 'debit')))
+        lines.append(StatementLine(reader.line_num,
+                                   dates[field(row, 'date')],
+                                   amount,
+                                   field(row, 'payee').decode('utf-8', 'replace'),
+                                   field(row, 'memo').decode('utf-8', 'replace')))
+    f.close()
+    return lines
+
+# Reads the transactions out of an OFX (or QFX) statement.  This works
+# for both the SGML (OFX 1.x) and XML (OFX 2.x) forms.
+def read_ofx_statement(filename):
+    f = open(filename, 'rb')
+    text = f.read()
+    f.close()
+
+    def tag(block, name):
+        match = re.search(r'<%s>([^<\r\n]*)' % (name), block, re.IGNORECASE)
+        if match:
+            return match.group(1).strip()
+        return ''
+
+    lines = []
+    for block in re.split(r'<STMTTRN>', text, flags=re.IGNORECASE)[1:]:
+        block = re.split(r'</STMTTRN>', block, flags=re.IGNORECASE)[0]
+        fitid = tag(block, 'FITID') or len(lines) + 1
+        # DTPOSTED is YYYYMMDD, optionally followed by a time and zone
+        posted = tag(block, 'DTPOSTED')[:8]
+        try:
+            date = datetime.date(int(posted[:4]), int(posted[4:6]), int(posted[6:8]))
+        except ValueError:
+            raise Exception('%s: transaction %s has no valid DTPOSTED date (%r)' % (filename, fitid, tag(block, 'DTPOSTED')))
+        lines.append(StatementLine(fitid,
+                                   date,
+                                   amount_from_statement(tag(block, 'TRNAMT')),
+                                   tag(block, 'NAME').decode('utf-8', 'replace'),
+                                   tag(block, 'MEMO').decode('utf-8', 'replace')))
+    return lines
+
+def read_statement(filename, date_format = None):
+    if os.path.splitext(filename)[1].lower() in ('.ofx', '.qfx'):
+        return read_ofx_statement(filename)
+    return read_csv_statement(filename, date_format)
+
+# Returns how similar two payees are, from 0 (nothing in common) to 1
+# (the same once normalized), by the words they share.  'words' is an
+# optional dictionary used to cache the words of each payee.
+def payee_similarity(a, b, words = None):
+    if words is None:
+        words = {}
+    for payee in (a, b):
+        if payee not in words:
+            words[payee] = set(normalize_payee(payee).split())
+    a = words[a]
+    b = words[b]
+    if not a or not b:
+        return 0.0
+    return float(len(a & b)) / len(a | b)
+
+# The result of matching a statement against an account.  Statement
+# lines are hash joined to the account's transactions on the amount in
+# cents; within each amount the transactions are sorted by date, so only
+# those within 'date_tolerance' days of a line are looked at.  When
+# there is more than one candidate the one with the most similar payee,
+# then the closest date, wins.  Exact date matches are made first so
+# that they can't be taken by a nearby line with the same amount.
+class Reconciliation:
+    def __init__(self, info, account, lines, date_tolerance = 3):
+        self.info = info
+        self.account = account
+        self.lines = sorted(lines, key = lambda line: (line.date, line.line))
+        self.date_tolerance = date_tolerance
+
+        if self.lines:
+            self.datestart = self.lines[0].date
+            self.dateend = self.lines[-1].date
+        else:
+            self.datestart = self.dateend = info.cash_flow_start
+
+        # Only transactions that could match a line are indexed.
+        txns = txns_between_dates(txns_in_account(proper_txns(info.transactions), account),
+                                  self.datestart - datetime.timedelta(days=date_tolerance),
+                                  self.dateend + datetime.timedelta(days=date_tolerance))
+        index = {}
+        for txn in sorted(txns, key = lambda txn: (txn.date, txn.key)):
+            entry = index.setdefault(amount_to_cents(txn.amount), ([], []))
+            entry[0].append(txn.date)
+            entry[1].append(txn)
+
+        self.payee_words = {}
+        self.matches = []
+        matched = set()
+        unmatched_lines = self.lines
+        for tolerance in (0, date_tolerance):
+            still_unmatched = []
+            for line in unmatched_lines:
+                txn = self.best_match(index, line, tolerance, matched)
+                if txn is None:
+                    still_unmatched.append(line)
+                else:
+                    matched.add(txn.key)
+                    self.matches.append((line, txn))
+            unmatched_lines = still_unmatched
+
+        self.unmatched_lines = unmatched_lines
+        self.unmatched_txns = [txn for txn in txns
+                               if txn.key not in matched and self.datestart <= txn.date <= self.dateend]
+        self.unmatched_txns.sort(key = lambda txn: (txn.date, txn.key))
+
+    def best_match(self, index, line, tolerance, matched):
+        entry = index.get(amount_to_cents(line.amount))
+        if entry is None:
+            return None
+        dates, txns = entry
+        lo = bisect.bisect_left(dates, line.date - datetime.timedelta(days=tolerance))
+        hi = bisect.bisect_right(dates, line.date + datetime.timedelta(days=tolerance))
+
+        best = None
+        best_score = None
+        for txn in txns[lo:hi]:
+            if txn.key in matched:
+                continue
+            score = (-payee_similarity(line.payee, txn.payee, self.payee_words), abs((txn.date - line.date).days), txn.key)
+            if best is None or score < best_score:
+                best = txn
+                best_score = score
+        return best
+
+    # Print out a report of the unmatched lines and transactions.
+    # Returns the difference between the statement and MoneyWell over
+    # the statement period (statement - MoneyWell).
+    def print_report(self):
+        name = self.info.accounts[self.account].name
+        print 'Reconciling account %d (%s) from %s to %s:' % \
+            (self.account, name, self.datestart.isoformat(), self.dateend.isoformat())
+        print '  Matched %d of %d statement line(s)' % (len(self.matches), len(self.lines))
+
+        missing_sum = round(sum([line.amount for line in self.unmatched_lines]), 2)
+        extra_sum = txn_amount_sum(self.unmatched_txns)
+
+        if self.unmatched_lines:
+            print '  ***'
+            print '  *** %d statement line(s) are missing from MoneyWell, totalling %.2f:' % (len(self.unmatched_lines), missing_sum)
+            for line in self.unmatched_lines:
+                print '  *** %s' % (line)
+            print '  ***'
+
+        if self.unmatched_txns:
+            print '  ***'
+            print '  *** %d MoneyWell transaction(s) are not on the statement, totalling %.2f:' % (len(self.unmatched_txns), extra_sum)
+            for txn in self.unmatched_txns:
+                print '  *** %s' % (txn)
+            print '  ***'
+
+        difference = round(missing_sum - extra_sum, 2)
+        if self.unmatched_lines or self.unmatched_txns:
+            print '  *** Statement exceeds MoneyWell by %.2f over the statement period' % (difference)
+        else:
+            print '  No issues found.'
+        return difference
+
+#
+# Text search.  A trigram index over the payee and memo of every
+# transaction, so transactions can be found by any part of their text,
+# or by text that is close to it, without scanning them all.  The index
+# can be kept in a sidecar SQLite file, in which case only the
+# transactions that changed since the last run are re-indexed.
+#
+
+# Returns the text of a transaction that is searched.  The payee and
+# memo are joined with a NUL, which can't be in a query (it can't be
+# typed on a command line), so that no match or trigram spans the two.
+def search_text(payee, memo):
+    return '\0'.join([(payee or '').lower(), (memo or '').lower()])
+
+def txn_search_text(txn):
+    return search_text(txn.payee, txn.memo)
+
+# Returns the set of trigrams (three character substrings) in the text
+def trigrams(text):
+    return set([text[i:i+3] for i in range(len(text) - 2)])
+
+# The version of the layout of a SearchIndex file.  An index with any
+# other version is rebuilt from scratch.
+SEARCH_INDEX_VERSION = 3
+
+# Posting lists are stored as little endian 32 bit integers, whatever
+# the platform.
+def pack_postings(keys):
+    data = array.array('i', keys)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tostring()
+
+def unpack_postings(blob):
+    data = array.array('i')
+    data.fromstring(blob)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data
+
+# An index of the trigrams in the payee and memo of each transaction
+# in a document.  'search_doc' keeps the payee and memo each
+# transaction was indexed with, and 'search_info' the version of the
+# layout and the source (see SearchIndex.update()) the index was last
+# brought up to date from.
+class SearchIndex:
+    def __init__(self, filename = ':memory:'):
+        self.con = sqlite3.connect(filename)
+        self.con.execute('create table if not exists search_info (name text primary key, value)')
+        version = self.con.execute("select value from search_info where name = 'version'").fetchone()
+        if version is None or version[0] != SEARCH_INDEX_VERSION:
+            self.con.execute('drop table if exists search_info')
+            self.con.execute('drop table if exists search_doc')
+            self.con.execute('drop table if exists search_posting')
+            self.con.execute('create table search_info (name text primary key, value)')
+            self.con.execute("insert into search_info values ('version', ?)", (SEARCH_INDEX_VERSION,))
+        self.con.execute('create table if not exists search_doc (key integer primary key, payee text, memo text, text text)')
+        self.con.execute('create table if not exists search_posting (gram text primary key, keys blob)')
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    # Brings the index up to date with the transactions in a BasicInfo,
+    # which were read in from the document 'filename' if it is given.
+    # The path and store_stamp() of the file the document's data is in
+    # are kept as the index's source, and if they haven't changed since
+    # the last update nothing is read at all.  Otherwise, for a SQLite
+    # store, SQLite compares each row's payee and memo with the ones
+    # indexed so that only the rows that changed are read; for a
+    # columnar export (or without 'filename') they are compared with
+    # those in 'info'.  Returns a tuple of the number of transactions
+    # (re)indexed and the number removed from the index.
+    def update(self, info, filename = None):
+        source = None
+        if filename is not None:
+            path = os.path.abspath(document_store_path(filename))
+            source = json.dumps([path, store_stamp(path)])
+            row = self.con.execute("select value from search_info where name = 'source'").fetchone()
+            if row is not None and row[0] == source:
+                return (0, 0)
+
+        if filename is not None and not is_columnar_export(filename):
+            changed, removed = self.store_changes(path)
+        else:
+            changed, removed = self.info_changes(info)
+
+        if source is None:
+            self.con.execute("delete from search_info where name = 'source'")
+        else:
+            self.con.execute("insert or replace into search_info values ('source', ?)", (source,))
+
+        if not changed and not removed:
+            self.con.commit()
+            return (0, 0)
+
+        # Work out which keys to add to and remove from each trigram's
+        # postings, using the old text of anything already indexed.
+        adds = {}
+        removes = {}
+        stale = removed + changed.keys()
+        for i in range(0, len(stale), 500):
+            batch = stale[i:i+500]
+            for key, text in self.con.execute('select key,text from search_doc where key in (%s)' % (','.join('?' * len(batch))), batch):
+                for gram in trigrams(text):
+                    removes.setdefault(gram, []).append(key)
+        for key, (payee, memo) in changed.items():
+            for gram in trigrams(search_text(payee, memo)):
+                adds.setdefault(gram, []).append(key)
+
+        for gram in set(adds.keys()) | set(removes.keys()):
+            keys = set(self.postings(gram))
+            keys.difference_update(removes.get(gram, []))
+            keys.update(adds.get(gram, []))
+            if keys:
+                self.con.execute('insert or replace into search_posting values (?,?)',
+                                 (gram, buffer(pack_postings(sorted(keys)))))
+            else:
+                self.con.execute('delete from search_posting where gram = ?', (gram,))
+
+        self.con.executemany('delete from search_doc where key = ?', [(key,) for key in removed])
+        self.con.executemany('insert or replace into search_doc values (?,?,?,?)',
+                             [(key, payee, memo, search_text(payee, memo)) for key, (payee, memo) in changed.items()])
+        self.con.commit()
+        return (len(changed), len(removed))
+
+    # Returns a dictionary of the (payee, memo) of each transaction in
+    # 'info' that isn't indexed with that payee and memo, and a list of
+    # the indexed transactions that aren't in 'info'.
+    def info_changes(self, info):
+        indexed = {}
+        for key, payee, memo in self.con.execute('select key,payee,memo from search_doc'):
+            indexed[key] = (payee, memo)
+
+        changed = {}
+        for txn in info.transactions.values():
+            if indexed.get(txn.key) != (txn.payee, txn.memo):
+                changed[txn.key] = (txn.payee, txn.memo)
+        removed = [key for key in indexed.keys() if key not in info.transactions]
+        return (changed, removed)
+
+    # Does the same thing as info_changes() for the transactions in the
+    # SQLite store at 'path', but has SQLite do the comparing.  The rows
+    # that transaction_from_row() ignores are left out.
+    def store_changes(self, path):
+        self.con.execute('attach database ? as store', (path,))
+        try:
+            rows = 'store.ZACTIVITY where not (ZDATEYMD is 0 and ZAMOUNT is 0)'
+            changed = {}
+            for key, payee, memo in self.con.execute('select Z_PK,ZPAYEE,ZMEMO from %s and not exists '
+                                                     '(select 1 from search_doc where key = Z_PK and payee is ZPAYEE and memo is ZMEMO)' % (rows)):
+                changed[key] = (payee, memo)
+            removed = [key for key, in self.con.execute('select key from search_doc where key not in (select Z_PK from %s)' % (rows))]
+        finally:
+            self.con.execute('detach database store')
+        return (changed, removed)
+
+    # Returns the keys of the transactions whose text contains the
+    # trigram
+    def postings(self, gram):
+        row = self.con.execute('select keys from search_posting where gram = ?', (gram,)).fetchone()
+        if row is None:
+            return array.array('i')
+        return unpack_postings(str(row[0]))
+
+    # Returns a list of (score, key) tuples for the transactions that
+    # match the query, best first.  Without 'fuzzy' the query must
+    # appear in the text (ignoring case) and every score is 1.  With
+    # 'fuzzy' a transaction matches if it shares at least 'threshold'
+    # of the query's trigrams, and the score is the fraction shared.
+    def search(self, query, fuzzy = False, threshold = 0.6):
+        query = query.lower()
+        grams = trigrams(query)
+
+        if not grams:
+            # Too short to have any trigrams, so fall back to a scan.
+            return [(1.0, key) for key, in self.con.execute("select key from search_doc where instr(text, ?) > 0", (query,))]
+
+        if not fuzzy:
+            # Intersect the postings, smallest first.
+            postings = sorted([self.postings(gram) for gram in grams], key = len)
+            keys = set(postings[0])
+            for other in postings[1:]:
+                if not keys:
+                    break
+                keys.intersection_update(other)
+
+            # Sharing every trigram doesn't guarantee a substring match,
+            # so check the text of the candidates.
+            keys = list(keys)
+            results = []
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                for key, text in self.con.execute('select key,text from search_doc where key in (%s)' % (','.join('?' * len(batch))), batch):
+                    if query in text:
+                        results.append((1.0, key))
+            return results
+
+        counts = {}
+        for gram in grams:
+            for key in self.postings(gram):
+                counts[key] = counts.get(key, 0) + 1
+        needed = max(1, int(math.ceil(threshold * len(grams))))
+        results = [(float(count) / len(grams), key) for key, count in counts.items() if count >= needed]
+        results.sort(key = lambda result: (-result[0], result[1]))
+        return results
+
+# Does the same thing as SearchIndex.search(), but by scanning the text
+# of every transaction in a BasicInfo.  This is quicker than building
+# an index that would only be used once.
+def scan_transactions(info, query, fuzzy = False, threshold = 0.6):
+    query = query.lower()
+    grams = trigrams(query)
+
+    if not fuzzy or not grams:
+        return [(1.0, txn.key) for txn in info.transactions.values() if query in txn_search_text(txn)]
+
+    # A trigram of the query is one of the text's if it appears in it.
+    needed = max(1, int(math.ceil(threshold * len(grams))))
+    results = []
+    for txn in info.transactions.values():
+        text = txn_search_text(txn)
+        count = len([gram for gram in grams if gram in text])
+        if count >= needed:
+            results.append((float(count) / len(grams), txn.key))
+    results.sort(key = lambda result: (-result[0], result[1]))
+    return results
+
+# Searches the transactions in a BasicInfo and prints those that match,
+# optionally limited to an account, a bucket and a date range.  If
+# 'index_filename' is given the search uses the index kept there
+# (bringing it up to date first with the document 'filename', which
+# 'info' was read in from, if given), and otherwise it scans the
+# transactions.
+def search_transactions(info, query, fuzzy = False, account = None, bucket = None,
+                        datestart = datetime.date.min, dateend = datetime.date.max, index_filename = None,
+                        filename = None):
+    if index_filename:
+        index = SearchIndex(index_filename)
+        index.update(info, filename)
+        results = index.search(query, fuzzy)
+        index.close()
+    else:
+        results = scan_transactions(info, query, fuzzy)
+
+    txns = []
+    for score, key in results:
+        txn = info.get_txn(key)
+        if txn is None:
+            continue
+        if account is not None and txn.account != account:
+            continue
+        if bucket is not None and txn.bucket != bucket:
+            continue
+        if not (datestart <= txn.date <= dateend):
+            continue
+        txns.append((score, txn))
+
+    if not fuzzy:
+        txns.sort(key = lambda result: (result[1].date, result[1].key))
+
+    print 'Found %d transaction(s) matching "%s":' % (len(txns), query)
+    for score, txn in txns:
+        if fuzzy:
+            print '  %3d%% %s' % (round(score * 100), txn)
+        else:
+            print '  %s' % (txn)
+    return [txn for score, txn in txns]
+
+#
+# Checkpoints.  Most of the history in a document never changes, but
+# every run reads and checks all of it.  Sealing the history up to a
+# date stores the account and bucket balances and the errors found by
+# the checks as of that date in a sidecar SQLite file, along with a
+# fingerprint of the rows they were worked out from.  Later runs have
+# SQLite work out the fingerprint again, which is much quicker than
+# reading the rows, and if it still matches only read in (and check)
+# the transactions after the sealed date.
+#
+
+# The multipliers for each column hashed by row_hash_sql(), and the
+# prime that the hashes are taken modulo.  The hashes are kept small
+# enough that summing them can't overflow SQLite's 64 bit integers.
+FINGERPRINT_MULTIPLIERS = [1000003, 999983, 100003, 99991, 65537, 10007, 9973, 8191]
+FINGERPRINT_MODULUS = 2147483647
+
+# Returns an SQL expression that hashes the (integer) columns of a row.
+def row_hash_sql(columns):
+    terms = ['(ifnull(%s, 0) %% %d) * %d' % (columns[i], FINGERPRINT_MODULUS, FINGERPRINT_MULTIPLIERS[i])
+             for i in range(len(columns))]
+    return '(%s) %% %d' % (' + '.join(terms), FINGERPRINT_MODULUS)
+
+# The columns of each table that the balances and checks depend on.
+FINGERPRINT_TRANSACTION_COLUMNS = ['Z_PK', 'ZDATEYMD', 'ZACCOUNT2', 'ZISBUCKETOPTIONAL', 'ZBUCKET2',
+                                   'ZTRANSFERSIBLING', 'ZSPLITPARENT', 'cast(round(ZAMOUNT * 100) as integer)']
+FINGERPRINT_MONEY_FLOW_COLUMNS = ['Z_PK', 'ZDATEYMD', 'ZBUCKET', 'ZTRANSFERSIBLING', 'cast(round(ZAMOUNT * 100) as integer)']
+
+# Returns a string describing the setup of a BasicInfo that the checks
+# depend on: when its accounts were bucketed and its check rules.
+def checkpoint_setup(info):
+    ranges = sorted([(account, [(date_range.datestart.isoformat(), date_range.dateend.isoformat()) for date_range in ranges])
+                     for account, ranges in info.semi_bucketed_accounts.items()])
+    rules = [(rule.check, sorted(rule.when.items()), rule.value, rule.sign, sorted(rule.counted.items()),
+              repr(rule.date_range), rule.min_amount, rule.max_amount) for rule in info.check_rules]
+    return repr((ranges, rules))
+
+# The state of a document's history up to and including the 'sealed'
+# date.  'account_balances' and 'bucket_balances' map a date to a
+# dictionary of the balance (in cents) of each account or bucket at
+# the end of that date: the sealed date, and the day before the cash
+# flow start date if that is earlier.  'account_cells' and
+# 'bucket_cells' are the monthly cells of the sealed history (see
+# BasicInfo.monthly_cells()), which the balances at the end of each
+# earlier month are worked out from.  'negative_intervals' are the
+# intervals in which a bucket was negative in the sealed history,
+# including those still open at the sealed date (see
+# BasicInfo.negative_bucket_intervals()), with each trigger as the
+# text it is reported as.  'check_errors' maps each of the TXN_CHECKS to the
+# error (in cents) it found in the sealed transactions.  'filename' is
+# the file the checkpoint was saved to or loaded from, if any.
+class Checkpoint:
+    def __init__(self, sealed, fingerprint, setup, cash_flow_start, starting_bucket_balances, bucketed_accounts,
+                 account_balances, bucket_balances, account_cells, bucket_cells, negative_intervals, check_errors,
+                 sealed_count, filename = None):
+        self.sealed = sealed
+        self.fingerprint = fingerprint
+        self.setup = setup
+        self.cash_flow_start = cash_flow_start
+        self.starting_bucket_balances = starting_bucket_balances
+        self.bucketed_accounts = bucketed_accounts
+        self.account_balances = account_balances
+        self.bucket_balances = bucket_balances
+        self.account_cells = account_cells
+        self.bucket_cells = bucket_cells
+        self.negative_intervals = negative_intervals
+        self.check_errors = check_errors
+        self.sealed_count = sealed_count
+        self.filename = filename
+
+    # Seals the history of a BasicInfo (with the whole document read
+    # in) up to and including 'date'.  'fingerprint' is the fingerprint
+    # of the sealed rows (see DataFile.get_sealed_fingerprint()).
+    @staticmethod
+    def seal(info, date, fingerprint):
+        account_ledger, bucket_ledger = info.build_balance_ledgers()
+
+        dates = [date]
+        if info.cash_flow_start - datetime.timedelta(days=1) < date:
+            dates.append(info.cash_flow_start - datetime.timedelta(days=1))
+        account_balances = {}
+        bucket_balances = {}
+        for balance_date in dates:
+            account_balances[balance_date] = dict([(account, account_ledger.balance_cents(account, balance_date))
+                                                   for account in info.accounts.keys()])
+        bucket_balances[date] = dict([(bucket, bucket_ledger.balance_cents(bucket, date)) for bucket in info.buckets.keys()])
+        account_cells, bucket_cells = info.monthly_cells(date)
+
+        negative_intervals = []
+        if date >= info.cash_flow_start:
+            intervals, negative, balances = info.negative_bucket_intervals(date)
+            for bucket, first, last, trigger, lowest, lowest_date in intervals + negative.values():
+                if trigger is not None:
+                    trigger = '%s' % (trigger)
+                negative_intervals.append((bucket, first, last, trigger, lowest, lowest_date))
+
+        check_errors = dict([(check, 0) for check in TXN_CHECKS])
+        matches = info.check_rule_matches()
+        for i in range(len(info.check_rules)):
+            rule = info.check_rules[i]
+            for txn, cents, counted in matches[i]:
+                if counted and txn.date <= date:
+                    check_errors[rule.check] += rule.sign * cents
+
+        return Checkpoint(sealed = date,
+                          fingerprint = fingerprint,
+                          setup = checkpoint_setup(info),
+                          cash_flow_start = info.cash_flow_start,
+                          starting_bucket_balances = dict([(bucket, amount_to_cents(balance))
+                                                           for bucket, balance in info.starting_bucket_balances.items()]),
+                          bucketed_accounts = dict([(account, bool(info.accounts[account].bucketed))
+                                                    for account in info.accounts.keys()]),
+                          account_balances = account_balances,
+                          bucket_balances = bucket_balances,
+                          account_cells = account_cells,
+                          bucket_cells = bucket_cells,
+                          negative_intervals = negative_intervals,
+                          check_errors = check_errors,
+                          sealed_count = len([txn for txn in info.transactions.values() if txn.date <= date]))
+
+    # Returns the balance of an account (in cents) at the end of a
+    # date on or before the sealed date.  Only the dates the
+    # checkpoint has balances for and the ends of months are known.
+    def account_balance_cents(self, account, date):
+        if date in self.account_balances:
+            return self.account_balances[date].get(account, 0)
+        return self.month_end_balance_cents('account', 0, self.account_cells.get(account, {}), date)
+
+    def bucket_balance_cents(self, bucket, date):
+        if date in self.bucket_balances:
+            return self.bucket_balances[date].get(bucket, 0)
+        return self.month_end_balance_cents('bucket', self.starting_bucket_balances.get(bucket, 0),
+                                            self.bucket_cells.get(bucket, {}), date)
+
+    # Returns the balance (in cents) at the end of a month from the
+    # opening balance and the cells of an account or bucket.
+    def month_end_balance_cents(self, kind, opening, cells, date):
+        if date != month_end_date(month_from_date(date)):
+            raise Exception('%s balances on %s are sealed in the checkpoint %s, which only has them for the ends of months' %
+                            (kind, date.isoformat(), self.filename or ''))
+        month = month_from_date(date)
+        return opening + sum([cell[0] for cell_month, cell in cells.items() if cell_month <= month])
+
+    # Returns the reason that the checkpoint can't be used for a
+    # document, or None if it can.  'probe' is a BasicInfo with the
+    # document's accounts, buckets and cash flow start (but not its
+    # transactions) with the setup applied, and 'fingerprint' is the
+    # fingerprint of the document's rows up to the sealed date.
+    def mismatch(self, probe, fingerprint):
+        if self.account_cells is None or self.negative_intervals is None:
+            return 'the checkpoint was written by an older version of this script'
+        if probe.cash_flow_start != self.cash_flow_start:
+            return 'the cash flow start date changed'
+        if dict([(bucket, amount_to_cents(balance)) for bucket, balance in probe.starting_bucket_balances.items()]) != \
+                self.starting_bucket_balances:
+            return 'the starting bucket balances changed'
+        if dict([(account, bool(probe.accounts[account].bucketed)) for account in probe.accounts.keys()]) != \
+                self.bucketed_accounts:
+            return 'the accounts changed'
+        if checkpoint_setup(probe) != self.setup:
+            return 'the bucketed date ranges or check rules changed'
+        if fingerprint != self.fingerprint:
+            return 'transactions or money flows up to %s changed' % (self.sealed.isoformat())
+        return None
+
+    def save(self, filename):
+        con = sqlite3.connect(filename)
+        con.execute('drop table if exists checkpoint_info')
+        con.execute('drop table if exists checkpoint_balance')
+        con.execute('drop table if exists checkpoint_cell')
+        con.execute('create table checkpoint_info (name text primary key, value text)')
+        con.execute('create table checkpoint_balance (kind text, key integer, date integer, balance integer)')
+        con.execute('create table checkpoint_cell (kind text, key integer, month integer, activity integer, inflow integer, outflow integer)')
+        con.executemany('insert into checkpoint_info values (?,?)', [
+            ('sealed', json.dumps(ymd_from_date(self.sealed))),
+            ('fingerprint', json.dumps(self.fingerprint)),
+            ('setup', json.dumps(self.setup)),
+            ('cash_flow_start', json.dumps(ymd_from_date(self.cash_flow_start))),
+            ('starting_bucket_balances', json.dumps(self.starting_bucket_balances.items())),
+            ('bucketed_accounts', json.dumps(self.bucketed_accounts.items())),
+            ('negative_intervals', json.dumps([(bucket, ymd_from_date(first), last and ymd_from_date(last), trigger,
+                                                lowest, ymd_from_date(lowest_date))
+                                               for bucket, first, last, trigger, lowest, lowest_date in self.negative_intervals])),
+            ('check_errors', json.dumps(self.check_errors)),
+            ('sealed_count', json.dumps(self.sealed_count)),
+        ])
+        for kind, balances in (('account', self.account_balances), ('bucket', self.bucket_balances)):
+            for date, date_balances in balances.items():
+                con.executemany('insert into checkpoint_balance values (?,?,?,?)',
+                                [(kind, key, ymd_from_date(date), cents) for key, cents in date_balances.items()])
+        for kind, all_cells in (('account', self.account_cells), ('bucket', self.bucket_cells)):
+            for key, cells in all_cells.items():
+                con.executemany('insert into checkpoint_cell values (?,?,?,?,?,?)',
+                                [(kind, key, month) + tuple(cell) for month, cell in cells.items()])
+        con.commit()
+        con.close()
+        self.filename = filename
+
+    # Loads a checkpoint that was previously saved with save().
+    @staticmethod
+    def load(filename):
+        if not os.path.exists(filename):
+            raise Exception('no checkpoint %s' % (filename))
+        con = sqlite3.connect(filename)
+
+        values = dict([(name, json.loads(value)) for name, value in con.execute('select name,value from checkpoint_info')])
+
+        balances = { 'account': {}, 'bucket': {} }
+        for kind, key, date, cents in con.execute('select kind,key,date,balance from checkpoint_balance'):
+            balances[kind].setdefault(date_from_ymd(date), {})[key] = cents
+
+        # Checkpoints written before the monthly cells were kept don't
+        # have them, and can't be used (see mismatch()).
+        cells = { 'account': None, 'bucket': None }
+        if con.execute("select name from sqlite_master where type='table' and name='checkpoint_cell'").fetchone():
+            cells = { 'account': {}, 'bucket': {} }
+            for row in con.execute('select kind,key,month,activity,inflow,outflow from checkpoint_cell'):
+                cells[row[0]].setdefault(row[1], {})[row[2]] = list(row[3:])
+
+        # Nor do checkpoints written before the negative intervals were.
+        negative_intervals = None
+        if 'negative_intervals' in values:
+            negative_intervals = [(bucket, date_from_ymd(first), last and date_from_ymd(last), trigger,
+                                   lowest, date_from_ymd(lowest_date))
+                                  for bucket, first, last, trigger, lowest, lowest_date in values['negative_intervals']]
+
+        con.close()
+        return Checkpoint(sealed = date_from_ymd(values['sealed']),
+                          fingerprint = values['fingerprint'],
+                          setup = values['setup'],
+                          cash_flow_start = date_from_ymd(values['cash_flow_start']),
+                          starting_bucket_balances = dict(values['starting_bucket_balances']),
+                          bucketed_accounts = dict(values['bucketed_accounts']),
+                          account_balances = balances['account'],
+                          bucket_balances = balances['bucket'],
+                          account_cells = cells['account'],
+                          bucket_cells = cells['bucket'],
+                          negative_intervals = negative_intervals,
+                          check_errors = values['check_errors'],
+                          sealed_count = values['sealed_count'],
+                          filename = filename)
+
+# Reads a document and seals its history up to and including 'date'.
+# 'setup' is an optional function that is applied to the BasicInfo
+# first, as it will be on later runs.  Returns the Checkpoint.
+def seal_document(filename, date, setup = None):
+    df = DataFile(filename)
+    df.open()
+    info = df.get_basic_info()
+    if setup:
+        setup(info)
+    return Checkpoint.seal(info, date, df.get_sealed_fingerprint(date))
+
+# Reads in the part of a document after a checkpoint.  'setup' is the
+# function that will be applied to the BasicInfo, which is needed to
+# tell whether the checkpoint still applies (it isn't applied to the
+# BasicInfo returned).  Returns a tuple of the BasicInfo, or None if
+# the checkpoint can't be used, and the reason it can't.
+def read_in_checkpointed_info(filename, checkpoint, setup = None):
+    df = DataFile(filename)
+    df.open()
+
+    accounts = df.get_accounts()
+    buckets = df.get_buckets()
+    cfsd = df.get_cash_flow_start_date()
+    sbb = df.get_starting_bucket_balances(buckets)
+
+    probe = BasicInfo(accounts, buckets, cfsd, sbb, {}, {})
+    if setup:
+        setup(probe)
+    reason = checkpoint.mismatch(probe, df.get_sealed_fingerprint(checkpoint.sealed))
+    if reason:
+        return (None, reason)
+
+    info = BasicInfo(accounts = accounts,
+                     buckets = buckets,
+                     cash_flow_start = cfsd,
+                     starting_bucket_balances = sbb,
+                     transactions = df.get_transactions_after(checkpoint.sealed),
+                     money_flows = df.get_money_flows_after(checkpoint.sealed),
+                     checkpoint = checkpoint,
+                     reference_transactions = df.get_reference_transactions(checkpoint.sealed))
+    return (info, None)
+
+#
+# Money flow graph.  Each money flow that moves money between buckets
+# has a sibling flow in the other bucket, with the negative side being
+# the bucket the money came from.  Pairing them up gives the edges of
+# a graph of which buckets funded which, which can be queried for any
+# date range or exported as an edge list.
+#
+
+# The periods that an edge list can be aggregated by, each a function
+# that returns the label of the period a date is in.
+FLOW_PERIODS = {
+    'day': lambda date: date.isoformat(),
+    'week': lambda date: (date - datetime.timedelta(days=date.weekday())).isoformat(),
+    'month': lambda date: '%04d-%02d' % (date.year, date.month),
+    'year': lambda date: '%04d' % (date.year),
+    'all': lambda date: '',
+}
+
+# The graph of money flows between buckets, built with a single pass
+# over the money flows.  An edge is a (source bucket, destination
+# bucket) tuple.  Flows without a sibling (or whose sibling is on the
+# same side) are kept as edges from or to None, so that the flows in
+# and out of a bucket still add up to its flow activity.
+#
+# The edges are aggregated by 'period' (one of FLOW_PERIODS) for
+# export, and kept as BalanceLedger's of running totals for queries
+# over any date range.
+class FlowGraph:
+    def __init__(self, info, period = 'month'):
+        if period not in FLOW_PERIODS:
+            raise Exception('unknown period %s' % (period))
+        self.info = info
+        self.period = period
+        period_of = FLOW_PERIODS[period]
+
+        # (period, source, destination) -> [number of flows, cents]
+        self.matrix = {}
+        amount_entries = {}
+        count_entries = {}
+        periods = {}    # date -> label of its period, since many flows share dates
+
+        for flow in info.money_flows.values():
+            cents = amount_to_cents(flow.amount)
+            if not cents:
+                continue
+            sibling = info.money_flows.get(flow.transfer_sibling)
+            if sibling is not None and (cents < 0) != (sibling.amount < 0):
+                if cents > 0:
+                    # The pair is counted from its negative side.
+                    continue
+                edge = (flow.bucket, sibling.bucket)
+                cents = -cents
+            elif cents < 0:
+                edge = (flow.bucket, None)
+                cents = -cents
+            else:
+                edge = (None, flow.bucket)
+
+            if flow.date not in periods:
+                periods[flow.date] = period_of(flow.date)
+            cell = self.matrix.setdefault((periods[flow.date],) + edge, [0, 0])
+            cell[0] += 1
+            cell[1] += cents
+            amount_entries.setdefault(edge, []).append((flow.date, cents))
+            count_entries.setdefault(edge, []).append((flow.date, 1))
+
+        # Running totals of the amount and the number of flows along
+        # each edge (the "balance" of an edge in 'counts' is the number
+        # of flows).
+        self.amounts = BalanceLedger({}, amount_entries)
+        self.counts = BalanceLedger({}, count_entries)
+
+        # The distinct (source, destination) edges
+        self.edges = amount_entries.keys()
+
+        self.sources_of = {}
+        self.destinations_of = {}
+        for source, destination in self.edges:
+            self.sources_of.setdefault(destination, []).append(source)
+            self.destinations_of.setdefault(source, []).append(destination)
+
+    # Returns a tuple of the number of flows and their total (in cents)
+    # along an edge from 'datestart' to 'dateend' (inclusive).
+    def edge_total(self, source, destination, datestart = datetime.date.min, dateend = datetime.date.max):
+        edge = (source, destination)
+        count = self.counts.balance_cents(edge, dateend)
+        cents = self.amounts.balance_cents(edge, dateend)
+        if datestart > datetime.date.min:
+            before = datestart - datetime.timedelta(days=1)
+            count -= self.counts.balance_cents(edge, before)
+            cents -= self.amounts.balance_cents(edge, before)
+        return (count, cents)
+
+    # Returns a list of (source bucket, number of flows, cents) tuples
+    # for the money that flowed into a bucket from 'datestart' to
+    # 'dateend', largest first.
+    def sources(self, bucket, datestart = datetime.date.min, dateend = datetime.date.max):
+        totals = [(source,) + self.edge_total(source, bucket, datestart, dateend) for source in self.sources_of.get(bucket, [])]
+        totals = [total for total in totals if total[1]]
+        totals.sort(key = lambda total: (-total[2], total[0]))
+        return totals
+
+    # Returns a list of (destination bucket, number of flows, cents)
+    # tuples for the money that flowed out of a bucket from 'datestart'
+    # to 'dateend', largest first.
+    def destinations(self, bucket, datestart = datetime.date.min, dateend = datetime.date.max):
+        totals = [(destination,) + self.edge_total(bucket, destination, datestart, dateend)
+                  for destination in self.destinations_of.get(bucket, [])]
+        totals = [total for total in totals if total[1]]
+        totals.sort(key = lambda total: (-total[2], total[0]))
+        return totals
+
+    def bucket_name(self, bucket):
+        if bucket is None:
+            return '(unpaired)'
+        if bucket in self.info.buckets:
+            return self.info.buckets[bucket].name
+        return '?'
+
+    # Writes the edges, aggregated by period, to a CSV file with a row
+    # for each period, source and destination.
+    def save_csv(self, filename):
+        f = open(filename, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(['period', 'source', 'source_name', 'destination', 'destination_name', 'flows', 'amount'])
+        for (period, source, destination), (count, cents) in sorted(self.matrix.items()):
+            writer.writerow([period, source if source is not None else '', self.bucket_name(source).encode('utf-8'),
+                             destination if destination is not None else '', self.bucket_name(destination).encode('utf-8'),
+                             count, '%.2f' % (cents_to_amount(cents))])
+        f.close()
+
+    # Prints where the money in a bucket came from and went to from
+    # 'datestart' to 'dateend'.
+    def print_bucket_report(self, bucket, datestart = datetime.date.min, dateend = datetime.date.max):
+        sources = self.sources(bucket, datestart, dateend)
+        destinations = self.destinations(bucket, datestart, dateend)
+
+        print 'Money flows of bucket %d (%s):' % (bucket, self.bucket_name(bucket))
+        for title, totals in (('From', sources), ('To', destinations)):
+            for other, count, cents in totals:
+                name = self.bucket_name(other)
+                if other is None:
+                    other = ''
+                print '  %-4s %4s %-30s %5d flow(s) %12.2f' % (title, other, name, count, cents_to_amount(cents))
+        print '  Net flows: %.2f' % (cents_to_amount(sum([total[2] for total in sources]) - sum([total[2] for total in destinations])))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Analyze a moneywell document')
     parser.add_argument('filename', type=str, default='testdata/matt_play_copy.moneywell',
@@ -874,10 +3863,127 @@ if __name__ == '__main__':
                         help='Increase verbosity of output')
     parser.add_argument('--cross-setup-disable', default=True, const=False, action='store_const',
                         help="Disable the special setup for the Cross's document")
+    parser.add_argument('--monthly', default=False, const=True, action='store_const',
+                        help='Print month-end balances of bucketed accounts and buckets')
+    parser.add_argument('--rollup', type=str, default=None, metavar='FILE',
+                        help='Use the monthly account and bucket rollup saved in a sidecar SQLite file, '
+                             'building and saving it there if the document has changed since')
+    parser.add_argument('--serve', type=int, default=None, metavar='PORT',
+                        help='Serve balance, check and transaction queries over HTTP instead of printing a report')
+    parser.add_argument('--bind', type=str, default='127.0.0.1', metavar='ADDRESS',
+                        help='Address for --serve to listen on (default 127.0.0.1)')
+    parser.add_argument('--duplicate-days', type=int, default=3, metavar='DAYS',
+                        help='How many days apart possible duplicate transactions can be (default 3)')
+    parser.add_argument('--assign-bucket', type=str, default=[], action='append', metavar='TXN=BUCKET',
+                        help='What-if: show the checks as if transaction TXN were assigned to BUCKET ("none" to unassign)')
+    parser.add_argument('--bucketed-from', type=str, default=[], action='append', metavar='ACCOUNT=YYYY-MM-DD',
+                        help='What-if: show the checks as if ACCOUNT (a name or number) were bucketed from the date on')
+    parser.add_argument('--export', type=str, default=None, metavar='DIRECTORY',
+                        help='Export the document to a directory of .npy columns (which can be analyzed in place of the document)')
+    parser.add_argument('--reconcile', type=str, default=None, metavar='STATEMENT',
+                        help='Match a CSV or OFX bank statement against the transactions in --account')
+    parser.add_argument('--search', type=str, default=None, metavar='TEXT',
+                        help='List the transactions whose payee or memo contains TEXT')
+    parser.add_argument('--fuzzy', default=False, const=True, action='store_const',
+                        help='Make --search also find text that is close to TEXT')
+    parser.add_argument('--search-index', type=str, default=None, metavar='FILE',
+                        help='Search with an index kept in a sidecar SQLite file, updating it as the document changes '
+                             '(without it, --search scans the transactions)')
+    parser.add_argument('--account', type=str, default=None,
+                        help='The account (a name or number) to --reconcile or --search')
+    parser.add_argument('--bucket', type=int, default=None,
+                        help='Limit --search to a bucket, or list the --flow-graph sources and destinations of a bucket')
+    parser.add_argument('--start', type=str, default=None, metavar='YYYY-MM-DD',
+                        help='Limit --search or the --flow-graph --bucket report to dates on or after the date')
+    parser.add_argument('--end', type=str, default=None, metavar='YYYY-MM-DD',
+                        help='Limit --search or the --flow-graph --bucket report to dates on or before the date')
+    parser.add_argument('--flow-graph', type=str, default=None, metavar='FILE',
+                        help='Export the bucket to bucket money flows as a CSV edge list')
+    parser.add_argument('--flow-period', type=str, default='month', choices=sorted(FLOW_PERIODS.keys()),
+                        help='The period to total the --flow-graph edges by (default month)')
+    parser.add_argument('--date-tolerance', type=int, default=3, metavar='DAYS',
+                        help='How many days apart a statement line and a transaction can be and still match (default 3)')
+    parser.add_argument('--statement-date-format', type=str, default=None, metavar='FORMAT',
+                        help='strptime() format of the dates in a CSV statement, if they are not recognized')
+    parser.add_argument('--diff', type=str, default=None, metavar='OLDFILE',
+                        help='Report what changed between OLDFILE (for example a backup) and the document')
+    parser.add_argument('--checkpoint', type=str, default=None, metavar='FILE',
+                        help='Start the report from the checkpoint in FILE, only reading and checking the history after it')
+    parser.add_argument('--seal', type=str, default=None, metavar='YYYY-MM-DD',
+                        help='Seal the history up to and including the date in the --checkpoint file')
 
     args = parser.parse_args()
 
-    info = read_in_basic_info(args.filename)
+    # Settings that are applied to a document once it is read in
+    def setup(info):
+        if not args.cross_setup_disable:
+            cross_setup(info)
+        info.duplicate_date_tolerance = args.duplicate_days
+
+    if args.serve is not None:
+        serve_queries(args.filename, args.bind, args.serve, setup, args.verbose)
+        sys.exit(0)
+
+    if args.diff:
+        diff_documents(args.diff, args.filename, setup)
+        sys.exit(0)
+
+    if args.seal:
+        if not args.checkpoint:
+            parser.error('--seal needs a --checkpoint file')
+        checkpoint = seal_document(args.filename, datetime.datetime.strptime(args.seal, '%Y-%m-%d').date(), setup)
+        checkpoint.save(args.checkpoint)
+        print 'Sealed %d transactions up to %s in %s' % (checkpoint.sealed_count, checkpoint.sealed.isoformat(), args.checkpoint)
+        sys.exit(0)
+
+    # The checkpoint is only used for the report, since the other
+    # commands need the whole history.
+    info = None
+    if args.checkpoint and not (args.export or args.reconcile or args.search or args.flow_graph):
+        checkpoint = Checkpoint.load(args.checkpoint)
+        info, reason = read_in_checkpointed_info(args.filename, checkpoint, setup)
+        if info is None:
+            print 'Not using the checkpoint in %s (%s), so checking the whole document' % (args.checkpoint, reason)
+
+    if info is None:
+        info = read_in_basic_info(args.filename)
+
+    if args.export:
+        export_columnar(info, args.export)
+        print 'Exported %d transactions and %d money flows to %s' % (len(info.transactions), len(info.money_flows), args.export)
+        sys.exit(0)
+
+    if args.reconcile:
+        if not args.account:
+            parser.error('--reconcile needs an --account')
+        lines = read_statement(args.reconcile, args.statement_date_format)
+        Reconciliation(info, account_from_arg(info, args.account), lines, args.date_tolerance).print_report()
+        sys.exit(0)
+
+    datestart = datetime.date.min
+    if args.start:
+        datestart = datetime.datetime.strptime(args.start, '%Y-%m-%d').date()
+    dateend = datetime.date.max
+    if args.end:
+        dateend = datetime.datetime.strptime(args.end, '%Y-%m-%d').date()
+
+    if args.search:
+        account = None
+        if args.account:
+            account = account_from_arg(info, args.account)
+        search_transactions(info, args.search.decode('utf-8'), args.fuzzy, account, args.bucket,
+                            datestart, dateend, args.search_index, args.filename)
+        sys.exit(0)
+
+    if args.flow_graph:
+        graph = FlowGraph(info, args.flow_period)
+        graph.save_csv(args.flow_graph)
+        print 'Exported %d rows (%d edges over %d periods) to %s' % \
+            (len(graph.matrix), len(graph.edges), len(set([cell[0] for cell in graph.matrix.keys()])), args.flow_graph)
+        if args.bucket is not None:
+            print ''
+            graph.print_bucket_report(args.bucket, datestart, dateend)
+        sys.exit(0)
 
     if args.verbose:
         print ''
@@ -915,14 +4021,48 @@ if __name__ == '__main__':
     print ''
     print 'Cash flow start date: %s' % (info.cash_flow_start.isoformat())
 
+    if info.checkpoint is not None:
+        print ''
+        print 'History up to %s (%d transactions) is sealed in the checkpoint' % \
+            (info.checkpoint.sealed.isoformat(), info.checkpoint.sealed_count)
+
     print ''
     print 'Found %d transactions' % (len(info.transactions))
 
     print ''
     print 'Found %d money flows' % (len(info.money_flows))
 
-    if not args.cross_setup_disable:
-        cross_setup(info)
+    setup(info)
+
+    # Make the what-if edits before running the checks, so that a
+    # mistake in one is reported before the rest of the report.
+    what_if = None
+    if args.assign_bucket or args.bucketed_from:
+        what_if = info.what_if()
+        for edit in args.assign_bucket:
+            txn, sep, bucket = edit.partition('=')
+            if not sep or not txn.isdigit() or not (bucket.isdigit() or bucket.lower() == 'none'):
+                parser.error('--assign-bucket %s is not of the form TXN=BUCKET' % (edit))
+            if bucket.lower() == 'none':
+                bucket = None
+            else:
+                bucket = int(bucket)
+            try:
+                what_if.assign_bucket(int(txn), bucket)
+            except Exception, e:
+                parser.error('--assign-bucket %s: %s' % (edit, e))
+        for edit in args.bucketed_from:
+            account, sep, date = edit.rpartition('=')
+            try:
+                date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+            except ValueError:
+                sep = ''
+            if not sep:
+                parser.error('--bucketed-from %s is not of the form ACCOUNT=YYYY-MM-DD' % (edit))
+            try:
+                what_if.add_account_bucketed_daterange(account_from_arg(info, account), DateRange(date, datetime.date.max))
+            except Exception, e:
+                parser.error('--bucketed-from %s: %s' % (edit, e))
 
     print ''
     info.print_sometimes_bucketed_accounts()
@@ -931,31 +4071,28 @@ if __name__ == '__main__':
     print 'Checking bucket balances against bucketed account balances:'
     info.check_bucket_balances()
 
-    error_sum = 0.0
-
-    print ''
-    print 'Checking cash flow start:'
-    error_sum += info.check_cash_flow_start()
-
-    print ''
-    print 'Checking for bucketed transactions in unbucketed accounts:'
-    error_sum += info.check_for_bucketed_txns_in_unbucketed_accounts()
-
-    print ''
-    print 'Checking for unbucketed transactions in bucketed accounts:'
-    error_sum += info.check_for_unbucketed_txns_in_bucketed_accounts()
+    if args.monthly or args.rollup:
+        if args.rollup:
+            rollup = read_in_rollup(info, args.filename, args.rollup)
+        else:
+            rollup = info.build_monthly_rollup()
+        if args.monthly:
+            print ''
+            info.print_monthly_balances(rollup)
 
-    print ''
-    print 'Checking split transactions for consistency:'
-    error_sum += info.check_splits();
+    error_sum = 0.0
 
-    print ''
-    print 'Checking transfers in bucketed accounts:'
-    error_sum += info.check_bucketed_account_transfers()
+    for description, check, in_total in CHECKS:
+        print ''
+        print '%s:' % (description)
+        check_error_sum = getattr(info, check)()
+        if in_total:
+            error_sum += check_error_sum
 
-    print ''
-    print 'Checking transfers in unbucketed accounts:'
-    error_sum += info.check_unbucketed_account_transfers()
+    if what_if is not None:
+        print ''
+        print 'What-if (none of these edits are written to the document):'
+        what_if.print_report()
 
     print ''
     print 'Done.'